@@ -3,18 +3,34 @@
 Docker Lab Manager - Deploy containers via HTTP API with unique IPs and Web Dashboard
 """
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify, render_template_string
 from flask_cors import CORS
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import array
+import calendar
+import contextlib
+import contextvars
 import docker
+import functools
+import heapq
 import ipaddress
+import itertools
 import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
 import threading
 import time
 import random
+import sqlite3
 import string
 import subprocess
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 
 app = Flask(__name__)
 
@@ -26,89 +42,2163 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize Docker client
-client = docker.from_env()
+# One shared client whose connection pool is sized for every worker pool
+# below plus the long-lived event/log streams; docker-py defaults to 10
+DOCKER_POOL_SIZE = int(os.environ.get('DOCKER_POOL_SIZE', 64))
+DOCKER_TIMEOUT = int(os.environ.get('DOCKER_TIMEOUT', 60))
+client = docker.from_env(max_pool_size=DOCKER_POOL_SIZE, timeout=DOCKER_TIMEOUT)
+
+# Prometheus metrics
+DEPLOY_PHASE_SECONDS = Histogram(
+    'doclab_deploy_phase_seconds', 'Duration of each deploy phase', ['phase'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+DOCKER_API_SECONDS = Histogram(
+    'doclab_docker_api_seconds', 'Docker API latency until response headers', ['operation'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+REQUEST_SECONDS = Histogram(
+    'doclab_http_request_seconds', 'Flask request latency until the response is returned', ['route', 'method']
+)
+REQUESTS_TOTAL = Counter(
+    'doclab_http_requests_total', 'Flask requests by route and status', ['route', 'method', 'status']
+)
+CLEANUP_SECONDS = Histogram(
+    'doclab_cleanup_seconds', 'Duration of the reconcile and exited-container cleanup pass',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+EVENT_LAG_SECONDS = Histogram(
+    'doclab_docker_event_lag_seconds', 'Delay between a Docker event and its handling',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+IP_POOL_CAPACITY = Gauge('doclab_ip_pool_capacity', 'Assignable addresses across the lab supernet')
+IP_POOL_IN_USE = Gauge('doclab_ip_pool_in_use', 'Addresses currently leased across all lab networks')
+NETWORK_SHARDS = Gauge('doclab_network_shards', 'Lab bridge networks currently in use')
+CONTAINERS_TRACKED = Gauge('doclab_containers_tracked', 'Containers tracked by the manager')
+REQUESTS_REJECTED = Counter(
+    'doclab_requests_rejected_total', 'Requests turned away with 429 or 503, by reason', ['reason']
+)
+DOCKER_GATE_ACTIVE = Gauge('doclab_docker_gate_active', 'Mutating Docker calls currently in flight')
+DOCKER_GATE_WAITING = Gauge('doclab_docker_gate_waiting', 'Mutating Docker calls queued for a slot')
+
+DOCKER_COLLECTION_VERBS = ('json', 'create', 'prune')
+
+def docker_operation(method, path):
+    """Collapse a Docker API path into a low-cardinality operation label"""
+    parts = re.sub(r'^/v[\d.]+', '', path).strip('/').split('/')
+    if len(parts) == 1:
+        return f"{method} {parts[0]}"
+    if len(parts) == 2 and parts[1] in DOCKER_COLLECTION_VERBS:
+        return f"{method} {parts[0]}/{parts[1]}"
+    # Image names may contain slashes; the action is always the last segment
+    if method == 'DELETE' or len(parts) == 2:
+        return f"{method} {parts[0]}/{{id}}"
+    return f"{method} {parts[0]}/{{id}}/{parts[-1]}"
+
+def observe_docker_call(response, *args, **kwargs):
+    """requests response hook timing every call made through the shared client"""
+    operation = docker_operation(response.request.method, response.request.path_url.split('?')[0])
+    elapsed = response.elapsed.total_seconds()
+    DOCKER_API_SECONDS.labels(operation).observe(elapsed)
+    # Docker calls show up as leaf spans under whatever phase issued them
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(trace.next_span_id(), f"docker {operation}", time.time() - elapsed, elapsed,
+                       current_span.get())
+
+# Internal tracing
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 500))
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Trace:
+    """Timed spans for one request or deploy job, offsets in ms from the trace start"""
+    
+    def __init__(self, name, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.spans = []
+        self._span_ids = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def next_span_id(self):
+        return next(self._span_ids)
+    
+    def add_span(self, span_id, name, started, duration, parent=None, error=None):
+        span = {
+            'id': span_id,
+            'parent': parent,
+            'name': name,
+            'start_ms': round((started - self.started) * 1000, 3),
+            'duration_ms': round(duration * 1000, 3)
+        }
+        if error:
+            span['error'] = error
+        with self._lock:
+            self.spans.append(span)
+    
+    def finish(self):
+        self.duration = time.time() - self.started
+    
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start_ms'])
+        return {
+            'id': self.id,
+            'name': self.name,
+            **self.attrs,
+            'started': self.started,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'spans': spans
+        }
+
+class TraceBuffer:
+    """Bounded buffer of recent traces"""
+    
+    def __init__(self, capacity):
+        self._traces = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+    
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+    
+    def get(self, trace_id):
+        with self._lock:
+            for trace in self._traces:
+                if trace.id == trace_id:
+                    return trace
+        return None
+    
+    def recent(self):
+        with self._lock:
+            return list(self._traces)
+
+trace_buffer = TraceBuffer(TRACE_BUFFER_SIZE)
+
+def start_trace(name, **attrs):
+    """Make a new trace current in this context; returns it with the reset token"""
+    trace = Trace(name, **attrs)
+    return trace, current_trace.set(trace)
+
+def finish_trace(trace, token):
+    trace.finish()
+    current_trace.reset(token)
+
+@contextlib.contextmanager
+def trace_span(name):
+    """Record a span on the current trace; a no-op when nothing is being traced"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.next_span_id()
+    parent = current_span.get()
+    token = current_span.set(span_id)
+    started = time.time()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        current_span.reset(token)
+        trace.add_span(span_id, name, started, time.time() - started, parent, error)
+
+def traced(name, func, *args, **kwargs):
+    """Call func inside a span of its own"""
+    with trace_span(name):
+        return func(*args, **kwargs)
 
 # Container tracking
 containers = {}
-network_manager = None
+containers_lock = threading.Lock()
+registry = None
+# Ids being recreated by a reset, mapped to their name; guarded by containers_lock
+resetting = {}
+
+# Labels stamped on every container created by the manager
+MANAGER_LABEL = 'doclab.manager'
+MANAGER_ID = os.environ.get('LAB_MANAGER_ID', 'uneolab')
+IP_LABEL = 'doclab.ip'
+POOL_LABEL = 'doclab.pool'
+TENANT_LABEL = 'doclab.tenant'
+PROFILE_LABEL = 'doclab.profile'
+NETWORK_LABEL = 'doclab.network'
+SHARD_LABEL = 'doclab.shard'
+LAB_LABEL = 'doclab.lab'
+SERVICE_LABEL = 'doclab.service'
+REGISTRY_PATH = os.environ.get('LAB_DB_PATH', '/app/data/doclab.db')
+
+# Docker event stream state
+CONTAINER_EVENT_STATUS = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'stop': 'exited',
+    'die': 'exited',
+}
+EVENT_RECONNECT_DELAY = 5
+
+# Docker hosts: the local daemon plus any endpoints in LAB_DOCKER_HOSTS
+LAB_HOST_NAME = os.environ.get('LAB_HOST_NAME', 'local')
+LAB_HOST_TAGS = [tag for tag in os.environ.get('LAB_HOST_TAGS', '').split(',') if tag]
+LAB_DOCKER_HOSTS = json.loads(os.environ.get('LAB_DOCKER_HOSTS', '[]'))
+HOST_MAX_CONTAINERS = int(os.environ.get('HOST_MAX_CONTAINERS', 500))
+HOST_CHECK_INTERVAL = float(os.environ.get('HOST_CHECK_INTERVAL', 15))
+PLACEMENT_STRATEGIES = ('least-loaded', 'bin-pack')
+PLACEMENT_STRATEGY = os.environ.get('PLACEMENT_STRATEGY', 'least-loaded')
+hosts = {}
+hosts_lock = threading.Lock()
+
+# Deploy job queue
+DEPLOY_WORKERS = int(os.environ.get('DEPLOY_WORKERS', 4))
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 100))
+MAX_JOB_HISTORY = 500
+deploy_executor = ThreadPoolExecutor(max_workers=DEPLOY_WORKERS, thread_name_prefix='deploy')
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Image availability cache
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', 300))
+PULL_POLICIES = ('always', 'if-not-present')
+DEFAULT_PULL_POLICY = os.environ.get('DEFAULT_PULL_POLICY', 'always')
+
+# Deploy profiles and tenant quotas
+DEFAULT_PROFILES = {
+    'small': {'mem_limit': '256m', 'memswap_limit': '256m', 'nano_cpus': 500_000_000, 'pids_limit': 128},
+    'default': {'mem_limit': '512m', 'memswap_limit': '512m', 'nano_cpus': 1_000_000_000, 'pids_limit': 256},
+    'large': {'mem_limit': '2g', 'memswap_limit': '2g', 'nano_cpus': 2_000_000_000, 'pids_limit': 1024},
+}
+DEPLOY_PROFILES = {**DEFAULT_PROFILES, **json.loads(os.environ.get('DEPLOY_PROFILES', '{}'))}
+PROFILE_HOST_CONFIG_KEYS = (
+    'mem_limit', 'memswap_limit', 'mem_reservation', 'nano_cpus',
+    'cpu_shares', 'pids_limit', 'shm_size'
+)
+# Quotas are opt-in: with none configured every tenant is unlimited. A 'default' entry
+# is one bucket shared by all tenants without a quota of their own, e.g.
+# {"default": {"max_containers": 200, "max_memory": "64g"}, "cs101": {"max_containers": 40}}
+TENANT_QUOTAS = json.loads(os.environ.get('TENANT_QUOTAS', '{}'))
+HOST_MEMORY_BUDGET = os.environ.get('HOST_MEMORY_BUDGET')
+
+# Warm container pools
+WARM_POOLS = json.loads(os.environ.get('WARM_POOLS', '[]'))
+POOL_WORKERS = int(os.environ.get('POOL_WORKERS', 2))
+POOL_MAX_SIZE = int(os.environ.get('POOL_MAX_SIZE', 50))
+pool_executor = ThreadPoolExecutor(max_workers=POOL_WORKERS, thread_name_prefix='pool')
+# Members dying this soon after creation back the refill off; enough in a row mark the pool failing
+POOL_EARLY_DEATH = float(os.environ.get('POOL_EARLY_DEATH', 30))
+POOL_BACKOFF = float(os.environ.get('POOL_BACKOFF', 5))
+POOL_BACKOFF_MAX = float(os.environ.get('POOL_BACKOFF_MAX', 300))
+POOL_MAX_FAILURES = int(os.environ.get('POOL_MAX_FAILURES', 5))
+warm_pools = {}
+warm_pools_lock = threading.Lock()
+# Pool configs whose leftover members are adopted once the local host is reachable
+deferred_warm_pools = []
+
+# Container log cache
+LOG_CACHE_TTL = float(os.environ.get('LOG_CACHE_TTL', 2))
+LOG_WORKERS = int(os.environ.get('LOG_WORKERS', 8))
+MAX_LOG_TAIL = 1000
+log_executor = ThreadPoolExecutor(max_workers=LOG_WORKERS, thread_name_prefix='logs')
+
+# Live log following
+LOG_FOLLOW_BACKLOG = int(os.environ.get('LOG_FOLLOW_BACKLOG', 500))
+LOG_SUBSCRIBER_QUEUE = 1000
+log_followers = {}
+log_followers_lock = threading.Lock()
+
+# Batch deploys
+BATCH_MAX_SEATS = int(os.environ.get('BATCH_MAX_SEATS', 500))
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', 16))
+
+# Lab templates: multi-container topologies deployed and removed as one unit
+DEFAULT_TEMPLATES = {
+    'web-db': {
+        'description': 'PHP web server backed by a MariaDB database',
+        'networks': {'frontend': {}, 'backend': {'internal': True}},
+        'services': {
+            'db': {'image': 'mariadb:11', 'profile': 'small', 'networks': ['backend'],
+                   'environment': {'MARIADB_ROOT_PASSWORD': 'lab'}},
+            'web': {'image': 'php:apache', 'depends_on': ['db'], 'networks': ['frontend', 'backend'],
+                    'environment': {'DB_HOST': 'db'}, 'expose': True}
+        }
+    }
+}
+LAB_TEMPLATES = json.loads(os.environ.get('LAB_TEMPLATES', '{}'))
+LAB_MAX_SERVICES = int(os.environ.get('LAB_MAX_SERVICES', 20))
+LAB_NAME_PATTERN = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9_.-]*')
+lab_templates = {}
+labs = {}
+labs_lock = threading.Lock()
+
+# Container snapshots for fast resets
+SNAPSHOT_REPOSITORY = os.environ.get('SNAPSHOT_REPOSITORY', 'doclab-snapshot')
+
+# Admission control: per-client token buckets on mutating routes and one
+# FIFO concurrency gate in front of every mutating Docker call
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 5))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 50))
+RATE_LIMIT_CLIENTS = 10000
+# e.g. X-Forwarded-For behind a proxy, or a per-student header set by the front end
+RATE_LIMIT_CLIENT_HEADER = os.environ.get('RATE_LIMIT_CLIENT_HEADER')
+DOCKER_CONCURRENCY = int(os.environ.get('DOCKER_CONCURRENCY', 16))
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', 64))
+MUTATING_METHODS = ('POST', 'DELETE')
+
+# Bulk cleanup
+CLEANUP_WORKERS = int(os.environ.get('CLEANUP_WORKERS', 16))
+CLEANUP_TIMEOUT = float(os.environ.get('CLEANUP_TIMEOUT', 30))
+
+# Container lifetimes and idle reaping (0 disables a limit)
+CONTAINER_TTL = float(os.environ.get('CONTAINER_TTL', 0))
+IDLE_TIMEOUT = float(os.environ.get('IDLE_TIMEOUT', 0))
+IDLE_CHECK_INTERVAL = float(os.environ.get('IDLE_CHECK_INTERVAL', 300))
+IDLE_CPU_SECONDS = float(os.environ.get('IDLE_CPU_SECONDS', 1.0))
+IDLE_NET_BYTES = int(os.environ.get('IDLE_NET_BYTES', 16384))
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', 60))
+REAPER_WORKERS = int(os.environ.get('REAPER_WORKERS', 4))
+reaper_executor = ThreadPoolExecutor(max_workers=REAPER_WORKERS, thread_name_prefix='reaper')
+idle_samples = {}
+idle_samples_lock = threading.Lock()
+
+# Container stats sampling
+STATS_INTERVAL = float(os.environ.get('STATS_INTERVAL', 10))
+STATS_WINDOW = int(os.environ.get('STATS_WINDOW', 60))
+STATS_WORKERS = int(os.environ.get('STATS_WORKERS', 8))
+
+# Network sharding: the supernet is carved into per-group bridge networks
+LAB_SUPERNET = os.environ.get('LAB_SUPERNET', '10.200.0.0/16')
+LAB_SHARD_PREFIX = int(os.environ.get('LAB_SHARD_PREFIX', 24))
+LAB_SHARD_BY = os.environ.get('LAB_SHARD_BY', 'tenant')
+LAB_NETWORK_PREFIX = os.environ.get('LAB_NETWORK_PREFIX', 'lab-net')
+LEGACY_NETWORK = 'lab-network'
+NETWORK_GC_DELAY = float(os.environ.get('NETWORK_GC_DELAY', 300))
+# Private lab networks get explicit subnets from their own pool; Docker's default
+# address pools only hold about 31 networks per daemon
+LAB_PRIVATE_SUPERNET = os.environ.get('LAB_PRIVATE_SUPERNET', '10.201.0.0/16')
+LAB_PRIVATE_PREFIX = int(os.environ.get('LAB_PRIVATE_PREFIX', 26))
+
+# Server-Sent Events
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 1000))
+SSE_KEEPALIVE = 15
+
+# Long-lived responses (event and log streams, streamed cleanups, waited deploys) each hold
+# a gunicorn thread until they finish; capping them below LAB_THREADS keeps the API answering
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', max(1, int(os.environ.get('LAB_THREADS', 64)) * 3 // 4)))
+STREAM_RETRY_AFTER = 5
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+class EventHub:
+    """Fans dashboard events out to Server-Sent Events subscribers"""
+    
+    def __init__(self, queue_size):
+        self._queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._seq = 0
+    
+    def subscribe(self):
+        subscription = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+    
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+    
+    def publish(self, event_type, data):
+        """Queue an event for every subscriber"""
+        payload = json.dumps(data)
+        with self._lock:
+            self._seq += 1
+            for subscription in self._subscribers:
+                try:
+                    subscription.put_nowait((self._seq, event_type, payload))
+                except queue.Full:
+                    # Slow client: drop its backlog and ask it to resync
+                    with subscription.mutex:
+                        subscription.queue.clear()
+                    subscription.put_nowait((self._seq, 'resync', '{}'))
+
+event_hub = EventHub(SSE_QUEUE_SIZE)
 
 # System logs for dashboard
-system_logs = []
-log_lock = threading.Lock()
+SYSTEM_LOG_CAPACITY = int(os.environ.get('SYSTEM_LOG_CAPACITY', 5000))
+SYSTEM_LOG_FILE = os.environ.get('SYSTEM_LOG_FILE')
+SYSTEM_LOG_MAX_BYTES = int(os.environ.get('SYSTEM_LOG_MAX_BYTES', 10 * 1024 * 1024))
+SYSTEM_LOG_BACKUPS = int(os.environ.get('SYSTEM_LOG_BACKUPS', 5))
+
+class SystemLogBuffer:
+    """Fixed-capacity ring buffer of system log entries with sequence ids"""
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._seq = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def last_id(self):
+        return self._seq
+    
+    def append(self, message, log_type):
+        """Store an entry in O(1), overwriting the oldest once full"""
+        with self._lock:
+            self._seq += 1
+            entry = {
+                'id': self._seq,
+                'timestamp': time.strftime("%H:%M:%S"),
+                'message': message,
+                'type': log_type
+            }
+            self._slots[self._seq % self.capacity] = entry
+        return entry
+    
+    def since(self, since=0, types=None, limit=None):
+        """Entries with id > since, oldest first, optionally filtered by type"""
+        # Only references are copied under the lock; filtering happens outside it
+        with self._lock:
+            last = self._seq
+            first = max(since + 1, last - self.capacity + 1, 1)
+            entries = [self._slots[seq % self.capacity] for seq in range(first, last + 1)]
+        if types:
+            entries = [entry for entry in entries if entry['type'] in types]
+        if limit is not None:
+            entries = entries[-limit:] if limit else []
+        return entries
+
+system_log_buffer = SystemLogBuffer(SYSTEM_LOG_CAPACITY)
+
+# Optional spill of system logs to a rotating file, written off the request path
+system_log_listener = None
+if SYSTEM_LOG_FILE:
+    spill_queue = queue.Queue(-1)
+    spill_logger = logging.getLogger('doclab.system')
+    spill_logger.propagate = False
+    spill_logger.addHandler(logging.handlers.QueueHandler(spill_queue))
+    spill_handler = logging.handlers.RotatingFileHandler(
+        SYSTEM_LOG_FILE, maxBytes=SYSTEM_LOG_MAX_BYTES, backupCount=SYSTEM_LOG_BACKUPS
+    )
+    system_log_listener = logging.handlers.QueueListener(spill_queue, spill_handler)
+    system_log_listener.start()
 
 def add_system_log(message, log_type='info'):
     """Add log to system logs with thread safety"""
-    with log_lock:
-        timestamp = time.strftime("%H:%M:%S")
-        system_logs.append({
-            'timestamp': timestamp,
-            'message': message,
-            'type': log_type
-        })
-        # Keep only last 100 logs
-        if len(system_logs) > 100:
-            system_logs.pop(0)
+    entry = system_log_buffer.append(message, log_type)
+    event_hub.publish('log', entry)
+    if system_log_listener:
+        spill_logger.info(json.dumps({**entry, 'time': time.time()}))
     logger.info(f"[{log_type.upper()}] {message}")
 
 # Generate random password on startup
 def generate_password():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
 
-API_PASSWORD = generate_password()
+# Listening port for the dev server; gunicorn.conf.py binds the same LAB_PORT
+LAB_PORT = int(os.environ.get('LAB_PORT', 62111))
+
+# Set LAB_API_PASSWORD to share one password across restarts and workers
+API_PASSWORD = os.environ.get('LAB_API_PASSWORD') or generate_password()
 print(f"\n{'='*50}")
 print(f"🔐 DOCKER LAB MANAGER CREDENTIALS")
 print(f"{'='*50}")
-print(f"📍 URL: http://localhost:62111")
+print(f"📍 URL: http://localhost:{LAB_PORT}")
 print(f"🔑 Password: {API_PASSWORD}")
 print(f"{'='*50}\n")
 
+class IPAllocator:
+    """Bitmap allocator over every host address of a subnet.
+    
+    One byte per address keeps a /16 at 64KB. Released offsets go on a
+    free list so allocate and release are O(1); fresh addresses come from
+    a cursor scan done by bytearray.find, which runs in C.
+    """
+    FREE, USED, RESERVED = 0, 1, 2
+    
+    def __init__(self, subnet, reserved=()):
+        self.network = ipaddress.IPv4Network(subnet, strict=False)
+        self._base = int(self.network.network_address)
+        self._bitmap = bytearray(self.network.num_addresses)
+        self._released = []
+        self._cursor = 0
+        self._in_use = 0
+        self._lock = threading.Lock()
+        
+        # Network and broadcast addresses are never handed out
+        self._bitmap[0] = self.RESERVED
+        self._bitmap[-1] = self.RESERVED
+        for first, last in reserved:
+            for offset in range(self._offset(first), self._offset(last) + 1):
+                self._bitmap[offset] = self.RESERVED
+        self._reserved = self._bitmap.count(self.RESERVED)
+    
+    def _offset(self, ip):
+        offset = int(ipaddress.IPv4Address(ip)) - self._base
+        if not 0 <= offset < len(self._bitmap):
+            raise ValueError(f"{ip} is outside {self.network}")
+        return offset
+    
+    def _address(self, offset):
+        return str(ipaddress.IPv4Address(self._base + offset))
+    
+    @property
+    def capacity(self):
+        return len(self._bitmap) - self._reserved
+    
+    @property
+    def in_use(self):
+        return self._in_use
+    
+    def allocate(self):
+        """Take the next free address"""
+        with self._lock:
+            while self._released:
+                offset = self._released.pop()
+                if self._bitmap[offset] == self.FREE:
+                    return self._take(offset)
+            
+            offset = self._bitmap.find(self.FREE, self._cursor)
+            if offset == -1:
+                offset = self._bitmap.find(self.FREE, 0, self._cursor)
+            if offset == -1:
+                raise Exception("No available IP addresses")
+            self._cursor = offset + 1
+            return self._take(offset)
+    
+    def _take(self, offset):
+        self._bitmap[offset] = self.USED
+        self._in_use += 1
+        return self._address(offset)
+    
+    def reserve(self, ip):
+        """Mark an address already in use (e.g. found on the network)"""
+        with self._lock:
+            offset = self._offset(ip)
+            if self._bitmap[offset] != self.FREE:
+                return False
+            self._take(offset)
+            return True
+    
+    def release(self, ip):
+        """Return an address to the pool"""
+        self.release_many([ip])
+    
+    def release_many(self, ips):
+        """Return several addresses under a single lock acquisition"""
+        offsets = []
+        for ip in ips:
+            try:
+                offsets.append(self._offset(ip))
+            except ValueError:
+                continue
+        with self._lock:
+            for offset in offsets:
+                if self._bitmap[offset] == self.USED:
+                    self._bitmap[offset] = self.FREE
+                    self._in_use -= 1
+                    self._released.append(offset)
+
+def parse_ip_ranges(spec):
+    """Parse 'a.b.c.d-e.f.g.h,w.x.y.z/24' into (first, last) pairs"""
+    ranges = []
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        if '/' in part:
+            net = ipaddress.IPv4Network(part, strict=False)
+            ranges.append((net.network_address, net.broadcast_address))
+        elif '-' in part:
+            first, last = part.split('-', 1)
+            ranges.append((first.strip(), last.strip()))
+        else:
+            ranges.append((part, part))
+    return ranges
+
+def clip_ip_ranges(ranges, network):
+    """Keep the parts of (first, last) ranges that fall inside a network"""
+    low, high = int(network.network_address), int(network.broadcast_address)
+    clipped = []
+    for first, last in ranges:
+        first, last = max(int(ipaddress.IPv4Address(first)), low), min(int(ipaddress.IPv4Address(last)), high)
+        if first <= last:
+            clipped.append((ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)))
+    return clipped
+
+def shard_group(tenant):
+    """Shard group a container is placed in"""
+    if LAB_SHARD_BY == 'tenant':
+        return tenant or 'shared'
+    return 'shared'
+
+class NetworkShard:
+    """One bridge network and its address allocator"""
+    
+    def __init__(self, name, subnet, group=None, index=None, network=None):
+        self.name = name
+        self.subnet = ipaddress.IPv4Network(subnet)
+        self.group = group
+        self.index = index
+        self.network = network
+        self.gateway = str(self.subnet.network_address + 1)
+        reserved = [(self.gateway, self.gateway)]
+        reserved += clip_ip_ranges(parse_ip_ranges(os.environ.get('LAB_RESERVED_IPS', '')), self.subnet)
+        self.allocator = IPAllocator(str(self.subnet), reserved)
+    
+    @property
+    def free(self):
+        return self.allocator.capacity - self.allocator.in_use
+    
+    def seed_endpoints(self):
+        """Addresses already on the network (e.g. foreign containers) are taken"""
+        for endpoint in ((self.network.attrs if self.network else {}).get('Containers') or {}).values():
+            address = endpoint.get('IPv4Address', '').split('/')[0]
+            if address:
+                self.allocator.reserve(address)
+    
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'subnet': str(self.subnet),
+            'group': self.group,
+            'in_use': self.allocator.in_use,
+            'capacity': self.allocator.capacity
+        }
+
+class ShardGroup:
+    """A group's shards bucketed by free addresses, so the least-loaded one is found in O(1)"""
+    
+    def __init__(self, max_free):
+        self._buckets = [set() for _ in range(max_free + 1)]
+        self._top = 0
+        self.size = 0
+    
+    def add(self, shard):
+        self._buckets[shard.free].add(shard)
+        self._top = max(self._top, shard.free)
+        self.size += 1
+    
+    def remove(self, shard, free=None):
+        self._buckets[shard.free if free is None else free].discard(shard)
+        self.size -= 1
+        while self._top > 0 and not self._buckets[self._top]:
+            self._top -= 1
+    
+    def update(self, shard, old_free):
+        """Re-bucket a shard after its free count changed"""
+        self.remove(shard, old_free)
+        self.add(shard)
+    
+    def least_loaded(self):
+        return next(iter(self._buckets[self._top])) if self._top > 0 else None
+
 class NetworkManager:
-    def __init__(self):
-        self.network_name = "lab-network"
-        self.subnet = "172.20.0.0/16"
-        self.gateway = "172.20.0.1"
-        self.ip_pool = self._generate_ip_pool()
-        self.used_ips = set()
-        self.setup_network()
+    """Places containers on per-group bridge shards carved out of the lab supernet.
     
-    def _generate_ip_pool(self):
-        """Generate available IP addresses"""
-        network = ipaddress.IPv4Network(self.subnet, strict=False)
-        # Skip network, gateway, and broadcast addresses
-        return [str(ip) for ip in network.hosts()][1:254]  # Skip first IP (gateway)
+    Shards are created on demand and removed once they have been empty for
+    NETWORK_GC_DELAY. A shard's index is its position in the supernet, so
+    the owning shard of an address is found arithmetically.
+    """
+    
+    def __init__(self, docker_client):
+        self.client = docker_client
+        self.supernet = ipaddress.IPv4Network(LAB_SUPERNET)
+        self.shard_size = 2 ** (32 - LAB_SHARD_PREFIX)
+        self.max_shard_free = self.shard_size - 3
+        self._base = int(self.supernet.network_address)
+        self._free_indexes = list(range(2 ** (LAB_SHARD_PREFIX - self.supernet.prefixlen)))
+        self.lab_supernet = ipaddress.IPv4Network(LAB_PRIVATE_SUPERNET)
+        self.lab_subnet_size = 2 ** (32 - LAB_PRIVATE_PREFIX)
+        self._free_lab_indexes = list(range(2 ** (LAB_PRIVATE_PREFIX - self.lab_supernet.prefixlen)))
+        self._lab_indexes_used = set()
+        self.shards = {}
+        self._by_index = {}
+        self._groups = {}
+        # Networks outside the current layout only route their existing containers
+        self._detached = []
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self.setup_network()
     
     def setup_network(self):
-        """Create or get the lab network"""
+        """Rediscover this manager's shards and the pre-sharding lab network"""
+        networks = self.client.networks.list(filters={'label': f'{MANAGER_LABEL}={MANAGER_ID}'}, greedy=True)
         try:
-            self.network = client.networks.get(self.network_name)
-            add_system_log(f"Using existing network: {self.network_name}")
+            networks.append(self.client.networks.get(LEGACY_NETWORK))
         except docker.errors.NotFound:
-            self.network = client.networks.create(
-                self.network_name,
-                driver="bridge",
-                ipam=docker.types.IPAMConfig(
-                    pool_configs=[
-                        docker.types.IPAMPool(
-                            subnet=self.subnet,
-                            gateway=self.gateway
-                        )
-                    ]
-                ),
-                attachable=True
-            )
-            add_system_log(f"Created network: {self.network_name}")
+            pass
+        
+        for network in networks:
+            # Private lab networks belong to their lab, not to the shard layout; only their subnet is taken
+            if LAB_LABEL in (network.attrs.get('Labels') or {}):
+                for config in (network.attrs.get('IPAM') or {}).get('Config') or []:
+                    index = self._lab_subnet_index(config.get('Subnet'))
+                    if index is not None and index not in self._lab_indexes_used:
+                        self._free_lab_indexes.remove(index)
+                        self._lab_indexes_used.add(index)
+                continue
+            if network.name in self.shards:
+                continue
+            subnet = ipaddress.IPv4Network(network.attrs['IPAM']['Config'][0]['Subnet'])
+            index = (int(subnet.network_address) - self._base) // self.shard_size
+            group = (network.attrs.get('Labels') or {}).get(SHARD_LABEL)
+            if group is not None and subnet.prefixlen == LAB_SHARD_PREFIX and index in self._free_indexes:
+                shard = NetworkShard(network.name, subnet, group, index, network)
+                self._free_indexes.remove(index)
+                # Seed first: the group buckets shards by their free count when they are registered
+                shard.seed_endpoints()
+                self._register(shard)
+            else:
+                # e.g. the pre-sharding lab-network; removed once it drains
+                shard = NetworkShard(network.name, subnet, network=network)
+                shard.seed_endpoints()
+                self.shards[shard.name] = shard
+                self._detached.append(shard)
+                add_system_log(f"Using network {network.name} for existing containers only")
+        heapq.heapify(self._free_indexes)
+        heapq.heapify(self._free_lab_indexes)
+        
+        add_system_log(f"🔧 {len(self._by_index)} network shards in {self.supernet} "
+                       f"(/{LAB_SHARD_PREFIX}, by {LAB_SHARD_BY})")
     
-    def get_next_ip(self):
-        """Get next available IP address"""
-        for ip in self.ip_pool:
-            if ip not in self.used_ips:
-                self.used_ips.add(ip)
-                return ip
-        raise Exception("No available IP addresses")
+    def _register(self, shard):
+        self.shards[shard.name] = shard
+        self._by_index[shard.index] = shard
+        self._groups.setdefault(shard.group, ShardGroup(self.max_shard_free)).add(shard)
+    
+    def shard_for_ip(self, ip):
+        """The shard owning an address, by arithmetic on the supernet"""
+        address = ipaddress.IPv4Address(ip)
+        if address in self.supernet:
+            shard = self._by_index.get((int(address) - self._base) // self.shard_size)
+            if shard is not None:
+                return shard
+        for shard in self._detached:
+            if address in shard.subnet:
+                return shard
+        return None
+    
+    def allocate(self, group):
+        """Lease an address on the group's least-loaded shard, adding a shard when all are full"""
+        while True:
+            with self._lock:
+                shard = self._groups.get(group) and self._groups[group].least_loaded()
+                if shard:
+                    old_free = shard.free
+                    ip = shard.allocator.allocate()
+                    self._groups[group].update(shard, old_free)
+                    return shard, ip
+            self._create_shard(group)
+    
+    def _create_shard(self, group):
+        with self._create_lock:
+            with self._lock:
+                if self._groups.get(group) and self._groups[group].least_loaded():
+                    return
+                if not self._free_indexes:
+                    raise Exception(f"No free network shards left in {self.supernet}")
+                index = heapq.heappop(self._free_indexes)
+            subnet = ipaddress.IPv4Network((self._base + index * self.shard_size, LAB_SHARD_PREFIX))
+            name = f"{LAB_NETWORK_PREFIX}-{index}"
+            try:
+                network = self.client.networks.create(
+                    name,
+                    driver="bridge",
+                    ipam=docker.types.IPAMConfig(
+                        pool_configs=[
+                            docker.types.IPAMPool(
+                                subnet=str(subnet),
+                                gateway=str(subnet.network_address + 1)
+                            )
+                        ]
+                    ),
+                    labels={MANAGER_LABEL: MANAGER_ID, SHARD_LABEL: group},
+                    attachable=True
+                )
+            except Exception:
+                with self._lock:
+                    heapq.heappush(self._free_indexes, index)
+                raise
+            with self._lock:
+                self._register(NetworkShard(name, subnet, group, index, network))
+        add_system_log(f"🌐 Created network shard {name} ({subnet}) for {group}")
+    
+    def reserve_ip(self, ip):
+        """Mark an address in use, e.g. one restored from the registry"""
+        shard = self.shard_for_ip(ip) if ip else None
+        if shard is None:
+            return
+        with self._lock:
+            old_free = shard.free
+            shard.allocator.reserve(ip)
+            if shard.index is not None and shard.name in self.shards:
+                self._groups[shard.group].update(shard, old_free)
     
     def release_ip(self, ip):
         """Release an IP address"""
-        self.used_ips.discard(ip)
+        if ip:
+            self.release_ips([ip])
+    
+    def release_ips(self, ips):
+        """Release a batch of IP addresses, grouped by shard"""
+        by_shard = {}
+        for ip in filter(None, ips):
+            shard = self.shard_for_ip(ip)
+            if shard is not None:
+                by_shard.setdefault(shard, []).append(ip)
+        emptied = []
+        with self._lock:
+            for shard, shard_ips in by_shard.items():
+                old_free = shard.free
+                shard.allocator.release_many(shard_ips)
+                if shard.index is not None and shard.name in self.shards:
+                    self._groups[shard.group].update(shard, old_free)
+                if shard.allocator.in_use == 0:
+                    emptied.append(shard.name)
+        for name in emptied:
+            reaper.schedule(time.time() + NETWORK_GC_DELAY, self.collect_shard, name)
+    
+    def collect_shard(self, name):
+        """Reaper task: remove a shard that is still empty"""
+        with self._lock:
+            shard = self.shards.get(name)
+            if shard is None or shard.allocator.in_use:
+                return
+            del self.shards[name]
+            if shard.index is None:
+                self._detached.remove(shard)
+            else:
+                del self._by_index[shard.index]
+                self._groups[shard.group].remove(shard)
+        try:
+            self.client.api.remove_network(name)
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            # Typically endpoints the manager does not own; keep serving the shard
+            add_system_log(f"⚠️ Could not remove empty network {name}: {str(e)}", 'warning')
+            with self._lock:
+                if shard.index is None:
+                    self.shards[name] = shard
+                    self._detached.append(shard)
+                else:
+                    self._register(shard)
+            return
+        if shard.index is not None:
+            with self._lock:
+                heapq.heappush(self._free_indexes, shard.index)
+        add_system_log(f"🧹 Removed empty network {name}")
+    
+    def _lab_subnet_index(self, subnet):
+        """Position of a subnet in the lab pool, or None if it is not one of the pool's"""
+        if not subnet:
+            return None
+        subnet = ipaddress.IPv4Network(subnet)
+        if subnet.prefixlen != LAB_PRIVATE_PREFIX or not subnet.subnet_of(self.lab_supernet):
+            return None
+        return (int(subnet.network_address) - int(self.lab_supernet.network_address)) // self.lab_subnet_size
+    
+    def allocate_lab_subnet(self):
+        """Carve a subnet for one private lab network out of LAB_PRIVATE_SUPERNET"""
+        with self._lock:
+            if not self._free_lab_indexes:
+                raise Exception(f"No free lab subnets left in {self.lab_supernet}")
+            index = heapq.heappop(self._free_lab_indexes)
+            self._lab_indexes_used.add(index)
+        return ipaddress.IPv4Network(
+            (int(self.lab_supernet.network_address) + index * self.lab_subnet_size, LAB_PRIVATE_PREFIX)
+        )
+    
+    def release_lab_subnet(self, subnet):
+        index = self._lab_subnet_index(subnet)
+        with self._lock:
+            if index in self._lab_indexes_used:
+                self._lab_indexes_used.discard(index)
+                heapq.heappush(self._free_lab_indexes, index)
+    
+    def networking_config(self, network_name, ip, aliases=None):
+        """Endpoint config pinning a container to the given address (None lets Docker pick)"""
+        return self.client.api.create_networking_config({
+            network_name: self.client.api.create_endpoint_config(ipv4_address=ip, aliases=aliases or None)
+        })
+    
+    @property
+    def in_use(self):
+        return sum(shard.allocator.in_use for shard in list(self.shards.values()))
+    
+    @property
+    def capacity(self):
+        """Addresses in existing shards plus those of shards that could still be created"""
+        existing = sum(shard.allocator.capacity for shard in list(self.shards.values()))
+        return existing + len(self._free_indexes) * self.max_shard_free
+    
+    def snapshot(self):
+        with self._lock:
+            shards = [shard.snapshot() for shard in self.shards.values()]
+            free_shards = len(self._free_indexes)
+            free_lab_subnets = len(self._free_lab_indexes)
+        return {
+            'supernet': str(self.supernet),
+            'shard_prefix': LAB_SHARD_PREFIX,
+            'shard_by': LAB_SHARD_BY,
+            'free_shards': free_shards,
+            'lab_supernet': str(self.lab_supernet),
+            'free_lab_subnets': free_lab_subnets,
+            'shards': sorted(shards, key=lambda shard: shard['name'])
+        }
+
+REGISTRY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+-- IP leases are rebuilt per host from the container records; the old global table is gone
+DROP TABLE IF EXISTS ip_leases;
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    submitted REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted);
+CREATE TABLE IF NOT EXISTS templates (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS labs (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+'''
+
+class Registry:
+    """SQLite store (WAL mode) for container records, job history, templates and labs"""
+    
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(REGISTRY_SCHEMA)
+    
+    def save_container(self, container_info):
+        """Insert or update a container record"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO containers (id, data) VALUES (?, ?)',
+                (container_info['id'], json.dumps(container_info))
+            )
+    
+    def delete_containers(self, container_ids):
+        """Remove container records in one transaction"""
+        rows = [(container_id,) for container_id in container_ids]
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM containers WHERE id = ?', rows)
+    
+    def load_containers(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM containers').fetchall()
+        return [json.loads(data) for (data,) in rows]
+    
+    def save_job(self, job):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO jobs (id, submitted, data) VALUES (?, ?, ?)',
+                (job['id'], job['submitted'], json.dumps(job))
+            )
+    
+    def load_jobs(self, limit):
+        """Load the most recent jobs, pruning older history"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM jobs WHERE id NOT IN '
+                '(SELECT id FROM jobs ORDER BY submitted DESC LIMIT ?)', (limit,)
+            )
+            rows = self._conn.execute('SELECT data FROM jobs ORDER BY submitted').fetchall()
+        return [json.loads(data) for (data,) in rows]
+    
+    def save_template(self, template):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO templates (name, data) VALUES (?, ?)',
+                (template['name'], json.dumps(template))
+            )
+    
+    def delete_template(self, name):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM templates WHERE name = ?', (name,))
+    
+    def load_templates(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM templates').fetchall()
+        return [json.loads(data) for (data,) in rows]
+    
+    def save_lab(self, lab):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO labs (id, data) VALUES (?, ?)', (lab['id'], json.dumps(lab)))
+    
+    def delete_lab(self, lab_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM labs WHERE id = ?', (lab_id,))
+    
+    def load_labs(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM labs').fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+class ImageCache:
+    """Tracks which image references are available locally.
+    
+    Entries are keyed by normalised reference and remember the image id and
+    repo digest. Digest-pinned references never expire; tagged ones are
+    re-checked after the TTL. Concurrent requests for the same reference
+    share one pull (single-flight).
+    """
+    
+    def __init__(self, ttl, docker_client):
+        self.ttl = ttl
+        self.client = docker_client
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'pulls': 0, 'present': 0}
+    
+    @staticmethod
+    def normalize(image):
+        repository, tag = docker.utils.parse_repository_tag(image)
+        if tag and tag.startswith('sha256:'):
+            return f"{repository}@{tag}"
+        return f"{repository}:{tag or 'latest'}"
+    
+    def _fresh(self, key, entry):
+        return '@' in key or time.time() - entry['fetched'] < self.ttl
+    
+    def ensure(self, image, policy='always'):
+        """Make an image available locally; returns 'cached', 'present' or 'pulled'"""
+        key = self.normalize(image)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._fresh(key, entry):
+                self.stats['hits'] += 1
+                return 'cached'
+            self.stats['misses'] += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+            else:
+                self.stats['coalesced'] += 1
+        
+        if not leader:
+            return flight.result()
+        
+        try:
+            outcome = self._fetch(key, policy)
+            flight.set_result(outcome)
+            return outcome
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+    
+    def _fetch(self, key, policy):
+        if policy == 'if-not-present':
+            try:
+                self._remember(key, self.client.images.get(key))
+                with self._lock:
+                    self.stats['present'] += 1
+                return 'present'
+            except docker.errors.ImageNotFound:
+                pass
+        
+        repository, tag = docker.utils.parse_repository_tag(key)
+        image = self.client.images.pull(repository, tag=tag)
+        self._remember(key, image)
+        with self._lock:
+            self.stats['pulls'] += 1
+        return 'pulled'
+    
+    def _remember(self, key, image):
+        digests = image.attrs.get('RepoDigests') or []
+        with self._lock:
+            self._entries[key] = {
+                'id': image.id,
+                'digest': digests[0] if digests else None,
+                'fetched': time.time()
+            }
+    
+    def invalidate(self, image_id):
+        """Forget every reference resolving to a deleted or untagged image"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e['id'] == image_id]:
+                del self._entries[key]
+    
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'inflight': len(self._inflight)}
+
+class DockerHost:
+    """One Docker endpoint with its own client, network shards, image cache, health and load"""
+    
+    def __init__(self, name, docker_client, url=None, tags=(), max_containers=HOST_MAX_CONTAINERS):
+        self.name = name
+        self.client = docker_client
+        self.url = url
+        self.tags = set(tags)
+        self.max_containers = max_containers
+        self.load = 0
+        self.image_cache = ImageCache(IMAGE_CACHE_TTL, docker_client)
+        self.network_manager = None
+        self.healthy = False
+        self.error = None
+        self.latency = None
+        self.last_check = None
+        self.event_stream = {'connected': False, 'last_event': None, 'reconnects': 0}
+        docker_client.api.hooks['response'].append(observe_docker_call)
+    
+    @property
+    def available(self):
+        return self.healthy and self.network_manager is not None
+    
+    def check(self):
+        """Ping the daemon; the first good ping also loads its network shards"""
+        started = time.time()
+        try:
+            self.client.ping()
+            if self.network_manager is None:
+                self.network_manager = NetworkManager(self.client)
+            self.healthy, self.error = True, None
+        except Exception as e:
+            self.healthy, self.error = False, str(e)
+        self.latency = round(time.time() - started, 3)
+        self.last_check = time.time()
+        return self.healthy
+    
+    def matches(self, spec):
+        """Whether a deploy pinned by host name or tags may run here"""
+        if spec.get('host') and spec['host'] != self.name:
+            return False
+        return set(spec.get('host_tags') or ()) <= self.tags
+    
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'url': self.url,
+            'tags': sorted(self.tags),
+            'healthy': self.healthy,
+            'error': self.error,
+            'latency': self.latency,
+            'last_check': self.last_check,
+            'load': self.load,
+            'max_containers': self.max_containers,
+            'event_stream': self.event_stream
+        }
+
+def docker_host_from_config(config):
+    """Build a DockerHost from one LAB_DOCKER_HOSTS entry (unix:// or tcp://, optional TLS)"""
+    tls = config.get('tls')
+    if tls:
+        tls = {} if tls is True else tls
+        tls = docker.tls.TLSConfig(
+            client_cert=tuple(tls['client_cert']) if tls.get('client_cert') else None,
+            ca_cert=tls.get('ca_cert'),
+            verify=tls.get('verify', True)
+        )
+    docker_client = docker.DockerClient(base_url=config['url'], tls=tls or False,
+                                        max_pool_size=DOCKER_POOL_SIZE, timeout=DOCKER_TIMEOUT)
+    return DockerHost(config['name'], docker_client, config['url'], config.get('tags', ()),
+                      int(config.get('max_containers', HOST_MAX_CONTAINERS)))
+
+def local_host():
+    return hosts.get(LAB_HOST_NAME)
+
+def host_for(container_info):
+    """The host a container record lives on; records from before multi-host are local"""
+    return hosts.get((container_info or {}).get('host', LAB_HOST_NAME))
+
+def container_client(container_id):
+    """Docker client for the host running a tracked container"""
+    host = host_for(containers.get(container_id))
+    return host.client if host else client
+
+def place_container(spec, count=1):
+    """Choose a host for count new containers and charge them to that host's load"""
+    strategy = spec.get('placement') or PLACEMENT_STRATEGY
+    with hosts_lock:
+        candidates = [
+            host for host in hosts.values()
+            if host.available and host.load + count <= host.max_containers and host.matches(spec)
+        ]
+        if not candidates:
+            raise Exception("No healthy Docker host with free capacity matches this deploy")
+        if strategy == 'bin-pack':
+            # Fill the fullest host first so the others stay free for large classes
+            host = min(candidates, key=lambda h: (-h.load / h.max_containers, h.name))
+        else:
+            host = min(candidates, key=lambda h: (h.load / h.max_containers, h.name))
+        host.load += count
+    return host
+
+def charge_placement(host, count=1):
+    with hosts_lock:
+        host.load += count
+
+def release_placement(host, count=1):
+    with hosts_lock:
+        host.load = max(host.load - count, 0)
+
+def for_each_host(func):
+    """Run func(host) on every available host concurrently; returns {name: result or exception}"""
+    targets = [host for host in hosts.values() if host.available]
+    if not targets:
+        return {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='hosts') as executor:
+        futures = {executor.submit(func, host): host for host in targets}
+        for future in as_completed(futures):
+            try:
+                results[futures[future].name] = future.result()
+            except Exception as e:
+                results[futures[future].name] = e
+    return results
+
+def check_hosts():
+    """Scheduled task: ping every Docker host concurrently and log health changes"""
+    try:
+        with ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix='ping') as executor:
+            previous = {name: host.healthy for name, host in hosts.items()}
+            for host, healthy in zip(hosts.values(), executor.map(DockerHost.check, hosts.values())):
+                if healthy and not previous[host.name]:
+                    add_system_log(f"🖥️ Docker host {host.name} is up", 'info')
+                    if host.name == LAB_HOST_NAME and deferred_warm_pools:
+                        configs = list(deferred_warm_pools)
+                        deferred_warm_pools.clear()
+                        pool_executor.submit(init_warm_pools, configs)
+                elif not healthy and previous[host.name]:
+                    add_system_log(f"❌ Docker host {host.name} is down: {host.error}", 'error')
+    finally:
+        reaper.schedule(time.time() + HOST_CHECK_INTERVAL, check_hosts)
+
+def init_docker_hosts():
+    """Register the local daemon and configured remote endpoints, then ping them all"""
+    hosts[LAB_HOST_NAME] = DockerHost(LAB_HOST_NAME, client, os.environ.get('DOCKER_HOST'), LAB_HOST_TAGS)
+    for config in LAB_DOCKER_HOSTS:
+        hosts[config['name']] = docker_host_from_config(config)
+    with ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix='ping') as executor:
+        list(executor.map(DockerHost.check, hosts.values()))
+    for host in hosts.values():
+        if host.healthy:
+            add_system_log(f"🖥️ Docker host {host.name} ready ({host.url or 'local socket'})", 'info')
+        else:
+            add_system_log(f"❌ Docker host {host.name} unreachable: {host.error}", 'error')
+
+class WarmPool:
+    """Pre-created containers for one image/profile in one shard group, claimed by /deploy"""
+    
+    def __init__(self, image, size, start=True, profile='default', environment=None, command=None,
+                 tenant='default'):
+        self.image = image
+        self.profile = profile
+        self.tenant = tenant
+        self.size = size
+        self.start = start
+        self.environment = environment or {}
+        self.command = command
+        self.ready = deque()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._retry_at = 0
+        self._filling = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def group(self):
+        return shard_group(self.tenant)
+    
+    @property
+    def name(self):
+        # Members sit on their group's shards, so a tenant's pool is its own
+        if self.group == 'shared':
+            return f"{self.image}/{self.profile}"
+        return f"{self.image}/{self.profile}@{self.group}"
+    
+    def matches(self, spec):
+        """Pool members are interchangeable only if the deploy asks for nothing custom"""
+        return (spec['environment'] or {}) == self.environment \
+            and spec['command'] == self.command and not spec['volumes']
+    
+    def member_spec(self):
+        return {
+            'image': self.image,
+            'name': f"doclab-pool-{uuid.uuid4().hex[:10]}",
+            'environment': dict(self.environment),
+            'volumes': {},
+            'command': self.command,
+            'profile': self.profile,
+            'tenant': self.tenant,
+            'host': LAB_HOST_NAME,
+            'labels': {POOL_LABEL: self.name}
+        }
+    
+    def claim(self):
+        with self._lock:
+            if self.ready:
+                self.hits += 1
+                return self.ready.popleft()
+            self.misses += 1
+            return None
+    
+    def add(self, container_info):
+        with self._lock:
+            self.ready.append(container_info)
+    
+    def discard(self, container_id):
+        with self._lock:
+            for container_info in self.ready:
+                if container_info['id'] == container_id:
+                    self.ready.remove(container_info)
+                    return container_info
+        return None
+    
+    def trim(self):
+        """Pop members beyond the configured size"""
+        with self._lock:
+            extra = max(len(self.ready) - self.size, 0)
+            return [self.ready.pop() for _ in range(extra)]
+    
+    @property
+    def failing(self):
+        return self.failures >= POOL_MAX_FAILURES
+    
+    def record_death(self, container_info):
+        """Note a member that exited on its own; returns the refill delay, growing with early deaths"""
+        with self._lock:
+            if time.time() - container_info.get('created', 0) > POOL_EARLY_DEATH:
+                self.failures = 0
+                return 0
+            self.failures += 1
+            delay = min(POOL_BACKOFF * 2 ** (self.failures - 1), POOL_BACKOFF_MAX)
+            self._retry_at = time.time() + delay
+            return delay
+    
+    def reset_failures(self):
+        with self._lock:
+            self.failures = 0
+            self._retry_at = 0
+    
+    def refill_async(self):
+        """Top the pool back up to size in the background"""
+        with self._lock:
+            # A failing pool waits for an operator to reconfigure it
+            if self.failures >= POOL_MAX_FAILURES or time.time() < self._retry_at:
+                return
+            missing = self.size - len(self.ready) - self._filling
+            if missing <= 0:
+                return
+            self._filling += missing
+        for _ in range(missing):
+            pool_executor.submit(self._fill_one)
+    
+    def _fill_one(self):
+        try:
+            local_host().image_cache.ensure(self.image, 'if-not-present')
+            self.add(launch_container(self.member_spec(), {}, start=self.start))
+        except Exception as e:
+            add_system_log(f"⚠️ Warm pool {self.name} refill failed: {str(e)}", 'warning')
+        finally:
+            with self._lock:
+                self._filling -= 1
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'image': self.image,
+                'profile': self.profile,
+                'group': self.group,
+                'size': self.size,
+                'start': self.start,
+                'ready': len(self.ready),
+                'filling': self._filling,
+                'hits': self.hits,
+                'misses': self.misses,
+                'failures': self.failures,
+                'failing': self.failures >= POOL_MAX_FAILURES
+            }
+
+class LogCache:
+    """Short-lived cache of container log tails shared by all clients"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+    
+    def get(self, container_id, tail):
+        """Return (logs, cached) for one container, reading at most once per TTL"""
+        key = (container_id, tail)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                return entry[1], True
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+        
+        if not leader:
+            return flight.result(), True
+        
+        try:
+            container = container_client(container_id).containers.prepare_model({'Id': container_id})
+            logs = container.logs(tail=tail).decode('utf-8', errors='ignore')
+            flight.set_result(logs)
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        
+        with self._lock:
+            self._entries[key] = (time.time(), logs)
+            if len(self._entries) > 1024:
+                cutoff = time.time() - self.ttl
+                for stale in [k for k, e in self._entries.items() if e[0] < cutoff]:
+                    del self._entries[stale]
+        return logs, False
+    
+    def get_many(self, container_ids, tail):
+        """Read many containers' logs concurrently; returns (logs, errors, cached)"""
+        futures = {log_executor.submit(self.get, cid, tail): cid for cid in container_ids}
+        logs, errors, cached = {}, {}, 0
+        for future in as_completed(futures):
+            container_id = futures[future]
+            try:
+                logs[container_id], hit = future.result()
+                cached += hit
+            except docker.errors.NotFound:
+                errors[container_id] = "Container not found"
+            except Exception as e:
+                errors[container_id] = f"Error retrieving logs: {str(e)}"
+        return logs, errors, cached
+
+log_cache = LogCache(LOG_CACHE_TTL)
+
+def parse_log_timestamp(stamp):
+    """RFC3339Nano Docker log timestamp -> integer nanoseconds since the epoch"""
+    date_part, _, fraction = stamp.rstrip('Z').partition('.')
+    seconds = calendar.timegm(time.strptime(date_part, '%Y-%m-%dT%H:%M:%S'))
+    return seconds * 10**9 + int((fraction + '000000000')[:9])
+
+def parse_log_cursor(cursor):
+    """'<unix_ns>:<offset>' -> (ns, offset); None when absent"""
+    if not cursor:
+        return None
+    ns, _, offset = cursor.partition(':')
+    return int(ns), int(offset or 0)
+
+def iter_log_entries(chunks):
+    """Split a timestamped Docker log stream into (cursor, message) entries.
+    
+    The cursor is the line's timestamp plus its index among lines sharing
+    that exact timestamp, so resuming never repeats or skips a line.
+    """
+    buffer = b''
+    last_ns, offset = None, 0
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for raw in lines:
+            stamp, _, text = raw.decode('utf-8', errors='ignore').partition(' ')
+            try:
+                ns = parse_log_timestamp(stamp)
+            except ValueError:
+                continue
+            offset = offset + 1 if ns == last_ns else 0
+            last_ns = ns
+            yield (ns, offset), {'cursor': f"{ns}:{offset}", 'timestamp': stamp, 'line': text}
+
+class LogFollower:
+    """One upstream follow stream for a container, fanned out to many subscribers"""
+    
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.backlog = deque(maxlen=LOG_FOLLOW_BACKLOG)
+        self.done = False
+        self.filled = threading.Event()
+        self._subscribers = set()
+        self._stream = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name=f"follow-{self.container_id[:12]}").start()
+    
+    def _run(self):
+        last = None
+        try:
+            container = container_client(self.container_id).containers.prepare_model({'Id': self.container_id})
+            # Fill the backlog before anyone subscribes so each subscriber gets only its own tail
+            for entry in iter_log_entries([container.logs(timestamps=True, tail=LOG_FOLLOW_BACKLOG)]):
+                last = entry[0]
+                self._publish(entry)
+            self.filled.set()
+            while not self.done:
+                # Reopened streams start at the last line seen; the cursor drops the overlap
+                window = {'since': last[0] / 1e9} if last else {'tail': LOG_FOLLOW_BACKLOG}
+                self._stream = container.logs(stream=True, follow=True, timestamps=True, **window)
+                try:
+                    for entry in iter_log_entries(self._stream):
+                        if last is None or entry[0] > last:
+                            last = entry[0]
+                            self._publish(entry)
+                    break
+                except Exception:
+                    if self.done:
+                        raise
+                    # A quiet container trips the client's read timeout; keep following while it runs
+                    container.reload()
+                    if container.status != 'running':
+                        break
+        except Exception as e:
+            if not self.done:
+                logger.info(f"Log follower for {self.container_id[:12]} stopped: {str(e)}")
+        finally:
+            with self._lock:
+                self.done = True
+                self.filled.set()
+                for subscription in self._subscribers:
+                    self._put_end(subscription)
+            with log_followers_lock:
+                if log_followers.get(self.container_id) is self:
+                    del log_followers[self.container_id]
+    
+    @staticmethod
+    def _put_end(subscription):
+        with subscription.mutex:
+            subscription.queue.clear()
+        subscription.put_nowait(None)
+    
+    def _publish(self, entry):
+        with self._lock:
+            self.backlog.append(entry)
+            for subscription in self._subscribers:
+                try:
+                    subscription.put_nowait(entry)
+                except queue.Full:
+                    # Slow reader: end its stream, it resumes from its cursor
+                    self._put_end(subscription)
+    
+    def subscribe(self, cursor, tail):
+        """Register a subscriber; returns (queue, replay entries, needs catch-up read)"""
+        subscription = queue.Queue(maxsize=LOG_SUBSCRIBER_QUEUE)
+        self.filled.wait(SSE_KEEPALIVE)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if self.done:
+                self._put_end(subscription)
+            if cursor is None:
+                return subscription, list(self.backlog)[-tail:] if tail else [], False
+            replay = [entry for entry in self.backlog if entry[0] > cursor]
+            gap = not self.backlog or cursor < self.backlog[0][0]
+            return subscription, replay, gap
+    
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+            idle = not self._subscribers
+        if idle:
+            with log_followers_lock:
+                if log_followers.get(self.container_id) is self and not self._subscribers:
+                    del log_followers[self.container_id]
+                    self.stop()
+    
+    def stop(self):
+        self.done = True
+        if self._stream is not None:
+            self._stream.close()
+
+def get_log_follower(container_id):
+    """Shared follower for a container, started on first use"""
+    with log_followers_lock:
+        follower = log_followers.get(container_id)
+        if follower is None or follower.done:
+            follower = log_followers[container_id] = LogFollower(container_id)
+            follower.start()
+        return follower
+
+def follow_log_entries(container_id, cursor, tail):
+    """Yield log entries after cursor, then live ones; None marks a keepalive tick"""
+    follower = get_log_follower(container_id)
+    subscription, replay, gap = follower.subscribe(cursor, tail)
+    last = cursor or (0, -1)
+    try:
+        if gap:
+            # The cursor predates the shared backlog: read the missing span once
+            container = container_client(container_id).containers.prepare_model({'Id': container_id})
+            since = max(cursor[0] // 10**9, 1)
+            replay = list(iter_log_entries([container.logs(timestamps=True, since=since)])) + replay
+        for key, message in replay:
+            if key > last:
+                last = key
+                yield message
+        while True:
+            try:
+                entry = subscription.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield None
+                continue
+            if entry is None:
+                return
+            key, message = entry
+            if key > last:
+                last = key
+                yield message
+    finally:
+        follower.unsubscribe(subscription)
+
+def profile_memory(profile):
+    """Memory limit of a deploy profile in bytes (0 when unlimited)"""
+    mem_limit = DEPLOY_PROFILES[profile].get('mem_limit')
+    return docker.utils.parse_bytes(mem_limit) if mem_limit else 0
+
+def profile_host_config(profile):
+    """Resource-limit kwargs for create_host_config from a deploy profile"""
+    settings = DEPLOY_PROFILES[profile]
+    return {key: settings[key] for key in PROFILE_HOST_CONFIG_KEYS if key in settings}
+
+class QuotaTracker:
+    """Running per-tenant container and memory counters, checked in O(1) before any daemon call"""
+    
+    def __init__(self, quotas, host_memory_budget=None):
+        self.quotas = {
+            tenant: {
+                'max_containers': limits.get('max_containers'),
+                'max_memory': docker.utils.parse_bytes(limits['max_memory']) if limits.get('max_memory') else None
+            }
+            for tenant, limits in quotas.items()
+        }
+        self.host_memory_budget = docker.utils.parse_bytes(host_memory_budget) if host_memory_budget else None
+        self.usage = {}
+        self.total_memory = 0
+        self._lock = threading.Lock()
+    
+    def bucket(self, tenant):
+        """Tenants without a quota of their own share the 'default' one, if there is one"""
+        return tenant if tenant in self.quotas or 'default' not in self.quotas else 'default'
+    
+    def limits(self, tenant):
+        return self.quotas.get(self.bucket(tenant)) or {}
+    
+    def reserve(self, tenant, count, memory):
+        """Charge containers to a tenant if they fit; returns an error message or None"""
+        tenant = self.bucket(tenant)
+        limits = self.limits(tenant)
+        with self._lock:
+            used = self.usage.setdefault(tenant, {'containers': 0, 'memory': 0})
+            max_containers = limits.get('max_containers')
+            if max_containers is not None and used['containers'] + count > max_containers:
+                return f"Tenant '{tenant}' container quota exceeded ({used['containers']}/{max_containers})"
+            max_memory = limits.get('max_memory')
+            if max_memory is not None and used['memory'] + memory > max_memory:
+                return f"Tenant '{tenant}' memory quota exceeded"
+            if self.host_memory_budget is not None and self.total_memory + memory > self.host_memory_budget:
+                return "Host memory budget exhausted"
+            used['containers'] += count
+            used['memory'] += memory
+            self.total_memory += memory
+        return None
+    
+    def charge(self, tenant, count, memory):
+        """Record usage without checking limits (restored or adopted containers)"""
+        with self._lock:
+            used = self.usage.setdefault(self.bucket(tenant), {'containers': 0, 'memory': 0})
+            used['containers'] += count
+            used['memory'] += memory
+            self.total_memory += memory
+    
+    def release(self, tenant, count, memory):
+        with self._lock:
+            used = self.usage.setdefault(self.bucket(tenant), {'containers': 0, 'memory': 0})
+            used['containers'] = max(used['containers'] - count, 0)
+            used['memory'] = max(used['memory'] - memory, 0)
+            self.total_memory = max(self.total_memory - memory, 0)
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'tenants': {
+                    tenant: {**used, **self.limits(tenant)} for tenant, used in self.usage.items()
+                },
+                'total_memory': self.total_memory,
+                'host_memory_budget': self.host_memory_budget
+            }
+
+quota_tracker = QuotaTracker(TENANT_QUOTAS, HOST_MEMORY_BUDGET)
+
+def reserve_quota(tenant, profiles):
+    """Reserve quota for containers using the given profiles; returns an error message or None"""
+    limits = quota_tracker.limits(tenant)
+    if limits.get('max_memory') is not None and any(not profile_memory(p) for p in profiles):
+        return "Profiles without a memory limit are not allowed for quota-limited tenants"
+    return quota_tracker.reserve(tenant, len(profiles), sum(profile_memory(p) for p in profiles))
+
+class DeadlineScheduler:
+    """Runs tasks at their deadlines from a min-heap; the thread sleeps until the earliest one"""
+    
+    def __init__(self, executor):
+        self._executor = executor
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+    
+    def schedule(self, deadline, func, *args):
+        """Queue func(*args) to run at the given epoch time"""
+        entry = (deadline, next(self._counter), func, args)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            # Only a new earliest deadline needs to wake the sleeping thread
+            if self._heap[0] is entry:
+                self._cond.notify()
+    
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+    
+    def next_deadline(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+    
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, func, args = heapq.heappop(self._heap)
+            self._executor.submit(self._run_task, func, args)
+    
+    def _run_task(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            add_system_log(f"❌ Scheduled task {func.__name__} failed: {str(e)}", 'error')
+
+reaper = DeadlineScheduler(reaper_executor)
+
+class RateLimiter:
+    """Per-client token buckets refilling at `rate` tokens per second up to `burst`.
+    
+    Buckets are kept in least-recently-seen order so the client table stays
+    bounded; an evicted client simply comes back with a full bucket.
+    """
+    
+    def __init__(self, rate, burst, max_clients=RATE_LIMIT_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def take(self, client, cost=1):
+        """Spend tokens for a client; returns 0 if allowed, else seconds until it would be"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / self.rate
+            if not wait:
+                tokens -= cost
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                del self._buckets[next(iter(self._buckets))]
+        return wait
+    
+    def snapshot(self):
+        with self._lock:
+            clients = len(self._buckets)
+        return {'rate': self.rate, 'burst': self.burst, 'clients': clients}
+
+class AdmissionGate:
+    """FIFO counting semaphore bounding concurrent mutating Docker calls.
+    
+    A released slot is handed straight to the longest waiter, so calls run in
+    arrival order. Background work always queues; request handlers check
+    `saturated` first and answer 429 instead of joining a full queue.
+    """
+    
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._waiters = deque()
+        self._hold = None
+        self._lock = threading.Lock()
+        self.stats = {'immediate': 0, 'queued': 0}
+    
+    def acquire(self):
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                self.stats['immediate'] += 1
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+            self.stats['queued'] += 1
+        waiter.wait()
+    
+    def release(self, held):
+        with self._lock:
+            # Moving average of slot hold time, for Retry-After estimates
+            self._hold = held if self._hold is None else 0.9 * self._hold + 0.1 * held
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+    
+    def call(self, func, *args, **kwargs):
+        """Run func while holding a slot, waiting in line for one if needed"""
+        self.acquire()
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(time.time() - started)
+    
+    @property
+    def waiting(self):
+        return len(self._waiters)
+    
+    @property
+    def saturated(self):
+        return len(self._waiters) >= self.max_waiting
+    
+    def retry_after(self):
+        """Seconds until the current queue has likely drained"""
+        with self._lock:
+            ahead = len(self._waiters) + 1
+            hold = self._hold or 1.0
+        return max(1, math.ceil(ahead * hold / self.limit))
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'waiting': len(self._waiters),
+                'max_waiting': self.max_waiting,
+                'avg_hold': round(self._hold, 3) if self._hold is not None else None,
+                **self.stats
+            }
+
+rate_limiter = RateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+docker_gate = AdmissionGate(DOCKER_CONCURRENCY, ADMISSION_QUEUE)
+
+def parse_tenant(data):
+    """Read the optional 'tenant' of a request body; missing or null means 'default'"""
+    tenant = data.get('tenant') or 'default'
+    if not isinstance(tenant, str):
+        raise ValueError("'tenant' must be a string")
+    return tenant
+
+def parse_lifetime(data):
+    """Read optional 'ttl' and 'idle_timeout' seconds from a request body"""
+    lifetime = []
+    for key in ('ttl', 'idle_timeout'):
+        value = data.get(key)
+        if value is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{key}' must be a number of seconds")
+            if value < 0:
+                raise ValueError(f"'{key}' must not be negative")
+        lifetime.append(value)
+    return tuple(lifetime)
+
+def validate_placement(data):
+    """Check the optional 'host', 'host_tags' and 'placement' fields of a deploy"""
+    if data.get('host') and data['host'] not in hosts:
+        return f"Unknown host '{data['host']}'"
+    if data.get('host_tags') is not None and not isinstance(data['host_tags'], list):
+        return "'host_tags' must be a list"
+    if data.get('placement') and data['placement'] not in PLACEMENT_STRATEGIES:
+        return f"'placement' must be one of {', '.join(PLACEMENT_STRATEGIES)}"
+    return None
+
+def dependency_levels(services):
+    """Group services into start levels where each level only depends on earlier ones"""
+    remaining = {service: set(config['depends_on']) for service, config in services.items()}
+    levels = []
+    while remaining:
+        ready = sorted(service for service, depends_on in remaining.items() if not depends_on)
+        if not ready:
+            raise ValueError(f"Dependency cycle between services {', '.join(sorted(remaining))}")
+        levels.append(ready)
+        for service in ready:
+            del remaining[service]
+        for depends_on in remaining.values():
+            depends_on.difference_update(ready)
+    return levels
+
+def validate_template(name, template):
+    """Normalise a lab template and order its services by dependency; raises ValueError"""
+    if not LAB_NAME_PATTERN.fullmatch(name or ''):
+        raise ValueError(f"Invalid template name '{name}'")
+    services = template.get('services')
+    if not isinstance(services, dict) or not services:
+        raise ValueError("Template needs a non-empty 'services' mapping")
+    if len(services) > LAB_MAX_SERVICES:
+        raise ValueError(f"Template exceeds {LAB_MAX_SERVICES} services")
+    # Without declared networks every service shares one private network
+    networks = template.get('networks') or {'default': {}}
+    if not isinstance(networks, dict):
+        raise ValueError("'networks' must be a mapping")
+    for network, config in networks.items():
+        if not LAB_NAME_PATTERN.fullmatch(network):
+            raise ValueError(f"Invalid network name '{network}'")
+        if config is not None and not isinstance(config, dict):
+            raise ValueError(f"Network '{network}' must be a mapping")
+    
+    normalized = {}
+    for service, config in services.items():
+        if not LAB_NAME_PATTERN.fullmatch(service):
+            raise ValueError(f"Invalid service name '{service}'")
+        if not isinstance(config, dict):
+            raise ValueError(f"Service '{service}' must be a mapping")
+        for key, kind in (('environment', dict), ('volumes', dict), ('depends_on', list), ('networks', list)):
+            if config.get(key) is not None and not isinstance(config[key], kind):
+                raise ValueError(f"'{key}' of service '{service}' must be a {'mapping' if kind is dict else 'list'}")
+        if not config.get('image'):
+            raise ValueError(f"Missing 'image' for service '{service}'")
+        profile = config.get('profile', 'default')
+        if not isinstance(profile, str) or profile not in DEPLOY_PROFILES:
+            raise ValueError(f"Unknown profile '{profile}' for service '{service}'")
+        depends_on = list(config.get('depends_on') or [])
+        for dependency in depends_on:
+            if dependency not in services:
+                raise ValueError(f"Service '{service}' depends on unknown service '{dependency}'")
+        service_networks = list(config.get('networks') or networks)
+        for network in service_networks:
+            if network not in networks:
+                raise ValueError(f"Service '{service}' uses undeclared network '{network}'")
+        normalized[service] = {
+            'image': config['image'],
+            'environment': dict(config.get('environment') or {}),
+            'volumes': dict(config.get('volumes') or {}),
+            'command': config.get('command'),
+            'profile': profile,
+            'depends_on': depends_on,
+            'networks': service_networks,
+            # Only exposed services also join a shard network and get a reachable IP
+            'expose': bool(config.get('expose'))
+        }
+    
+    return {
+        'name': name,
+        'description': template.get('description', ''),
+        'networks': {network: {'internal': bool((config or {}).get('internal'))}
+                     for network, config in networks.items()},
+        'services': normalized,
+        'levels': dependency_levels(normalized)
+    }
+
+def lifetime_fields(spec, created):
+    """Expiry and idle-timeout fields for a new container_info"""
+    ttl = spec.get('ttl')
+    idle_timeout = spec.get('idle_timeout')
+    ttl = CONTAINER_TTL if ttl is None else ttl
+    idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+    return {
+        'expires_at': created + ttl if ttl else None,
+        'idle_timeout': idle_timeout or None,
+        'last_active': created
+    }
+
+class RollingWindow:
+    """Fixed-size ring of float samples stored in a compact array"""
+    
+    def __init__(self, size):
+        self._values = array.array('d', bytes(8 * size))
+        self._next = 0
+        self.count = 0
+    
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        self.count = min(self.count + 1, len(self._values))
+    
+    def values(self):
+        """Samples oldest first"""
+        if self.count < len(self._values):
+            return self._values[:self.count].tolist()
+        return (self._values[self._next:] + self._values[:self._next]).tolist()
+    
+    def last(self):
+        return self._values[self._next - 1] if self.count else None
+    
+    def percentile(self, pct):
+        ordered = sorted(self._values[:self.count])
+        if not ordered:
+            return None
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+class ContainerStats:
+    """Rolling CPU, memory and network windows for one container"""
+    
+    def __init__(self, size):
+        self.cpu_percent = RollingWindow(size)
+        self.memory = RollingWindow(size)
+        self.rx_rate = RollingWindow(size)
+        self.tx_rate = RollingWindow(size)
+        self.memory_limit = None
+        self.previous = None
+        self.updated = None
+    
+    def record(self, stats, now):
+        """Turn one stats snapshot into rates against the previous snapshot"""
+        cpu = (stats.get('cpu_stats') or {}).get('cpu_usage', {}).get('total_usage', 0)
+        networks = stats.get('networks') or {}
+        rx = sum(n.get('rx_bytes', 0) for n in networks.values())
+        tx = sum(n.get('tx_bytes', 0) for n in networks.values())
+        memory_stats = stats.get('memory_stats') or {}
+        # Page cache is reclaimable; cgroup v1 reports it as 'cache', v2 as 'inactive_file'
+        cache = (memory_stats.get('stats') or {}).get('inactive_file',
+                 (memory_stats.get('stats') or {}).get('cache', 0))
+        self.memory.append(max(memory_stats.get('usage', 0) - cache, 0))
+        self.memory_limit = memory_stats.get('limit')
+        
+        if self.previous is not None:
+            elapsed = now - self.previous[0]
+            deltas = (cpu - self.previous[1], rx - self.previous[2], tx - self.previous[3])
+            # Negative deltas mean the container restarted; skip that interval
+            if elapsed > 0 and min(deltas) >= 0:
+                self.cpu_percent.append(deltas[0] / 1e9 / elapsed * 100)
+                self.rx_rate.append(deltas[1] / elapsed)
+                self.tx_rate.append(deltas[2] / elapsed)
+        self.previous = (now, cpu, rx, tx)
+        self.updated = now
+    
+    def summary(self):
+        memory = self.memory.values()
+        return {
+            'samples': self.memory.count,
+            'updated': self.updated,
+            'cpu_percent': {
+                'current': self.cpu_percent.last(),
+                'p50': self.cpu_percent.percentile(50),
+                'p95': self.cpu_percent.percentile(95)
+            },
+            'memory': {
+                'current': self.memory.last(),
+                'peak': max(memory) if memory else None,
+                'limit': self.memory_limit
+            },
+            'network': {
+                'rx_rate': self.rx_rate.last(),
+                'tx_rate': self.tx_rate.last()
+            }
+        }
+    
+    def series(self):
+        return {
+            'cpu_percent': self.cpu_percent.values(),
+            'memory': self.memory.values(),
+            'rx_rate': self.rx_rate.values(),
+            'tx_rate': self.tx_rate.values()
+        }
+
+class StatsSampler:
+    """Samples running managed containers on a fixed worker pool, one snapshot per interval"""
+    
+    def __init__(self, interval, window, workers):
+        self.interval = interval
+        self.window = window
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stats')
+        self._stats = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.last_round = {'started': None, 'duration': None, 'sampled': 0, 'skipped': 0}
+    
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                self.sample_round()
+            except Exception as e:
+                add_system_log(f"❌ Stats sampler error: {str(e)}", 'error')
+            time.sleep(max(self.interval - (time.time() - started), 0))
+    
+    def sample_round(self):
+        """Queue one snapshot per running container; slow ones are skipped rather than piled up"""
+        started = time.time()
+        with containers_lock:
+            running = [cid for cid, info in containers.items() if info['status'] == 'running']
+        with self._lock:
+            for container_id in set(self._stats) - set(running):
+                del self._stats[container_id]
+            due = [cid for cid in running if cid not in self._in_flight]
+            self._in_flight.update(due)
+        futures = [self._executor.submit(self._sample, cid) for cid in due]
+        wait(futures, timeout=self.interval)
+        self.last_round = {
+            'started': started,
+            'duration': round(time.time() - started, 3),
+            'sampled': len(due),
+            'skipped': len(running) - len(due)
+        }
+    
+    def _sample(self, container_id):
+        try:
+            api = container_client(container_id).api
+            one_shot = True if docker.utils.version_gte(api.api_version, '1.41') else None
+            stats = api.stats(container_id, stream=False, one_shot=one_shot)
+            with self._lock:
+                if container_id not in self._stats:
+                    self._stats[container_id] = ContainerStats(self.window)
+                self._stats[container_id].record(stats, time.time())
+        except docker.errors.NotFound:
+            pass
+        finally:
+            with self._lock:
+                self._in_flight.discard(container_id)
+    
+    def summary(self, container_id):
+        with self._lock:
+            container_stats = self._stats.get(container_id)
+            return container_stats.summary() if container_stats else None
+    
+    def series(self, container_id):
+        with self._lock:
+            container_stats = self._stats.get(container_id)
+            return container_stats.series() if container_stats else None
+    
+    def summaries(self):
+        with self._lock:
+            return {cid: container_stats.summary() for cid, container_stats in self._stats.items()}
+    
+    def snapshot(self):
+        with self._lock:
+            tracked = len(self._stats)
+        return {'interval': self.interval, 'window': self.window, 'tracked': tracked, **self.last_round}
+
+stats_sampler = StatsSampler(STATS_INTERVAL, STATS_WINDOW, STATS_WORKERS)
 
 # Dashboard HTML Template
 DASHBOARD_HTML = '''
@@ -353,7 +2443,7 @@ DASHBOARD_HTML = '''
         <h1>🐳 DOCKER LAB MANAGER</h1>
         <div class="credentials">
             <div class="credential-item">📍 <strong>IP:</strong> localhost</div>
-            <div class="credential-item">🔌 <strong>Port:</strong> 62111</div>
+            <div class="credential-item">🔌 <strong>Port:</strong> {{ port }}</div>
             <div class="credential-item">🔑 <strong>Password:</strong> <span class="password">{{ password }}</span></div>
         </div>
     </div>
@@ -363,7 +2453,7 @@ DASHBOARD_HTML = '''
             <h2>📊 System Logs <span class="terminal-cursor"></span></h2>
             <div class="logs scrollbar" id="systemLogs">
                 <div class="log-entry info">[SYSTEM] Docker Lab Manager initialized</div>
-                <div class="log-entry info">[NETWORK] Lab network ready: 172.20.0.0/16</div>
+                <div class="log-entry info">[NETWORK] Lab network ready: {{ supernet }} in /{{ shard_prefix }} shards</div>
                 <div class="log-entry info">[AUTH] Password generated: {{ password }}</div>
             </div>
         </div>
@@ -432,108 +2522,185 @@ DASHBOARD_HTML = '''
             }
         }
         
-        // Fetch system logs from server
-        function updateSystemLogs() {
-            fetch('/system-logs')
+        // Append a server log entry, skipping ones already shown
+        let lastLogId = 0;
+        function appendSystemLog(log) {
+            if (log.id <= lastLogId) return;
+            lastLogId = log.id;
+            
+            const logs = document.getElementById('systemLogs');
+            const logEntry = document.createElement('div');
+            logEntry.className = `log-entry ${log.type}`;
+            logEntry.innerHTML = `[${log.timestamp}] ${log.message}`;
+            logs.appendChild(logEntry);
+            
+            // Keep the 3 initial entries plus the last 100 server logs
+            while (logs.children.length > 103) {
+                logs.removeChild(logs.children[3]);
+            }
+            logs.scrollTop = logs.scrollHeight;
+        }
+        
+        // Container cards keyed by container id, updated in place
+        const containerCards = new Map();
+        
+        function renderContainerCount() {
+            const grid = document.getElementById('containersGrid');
+            document.getElementById('containerCount').textContent = `(${containerCards.size})`;
+            
+            if (containerCards.size === 0) {
+                grid.innerHTML = `
+                    <div style="text-align: center; color: #666; margin-top: 50px;">
+                        No containers deployed yet...<br>
+                        <small>Use API with password to deploy containers</small>
+                    </div>
+                `;
+            }
+        }
+        
+        // Returns true when a new card was added; the caller fetches its logs
+        function upsertContainer(container) {
+            // Filter out management container
+            if (container.name.includes('docker-lab-manager')) return false;
+            
+            let card = containerCards.get(container.id);
+            const added = !card;
+            if (!card) {
+                const grid = document.getElementById('containersGrid');
+                if (containerCards.size === 0) grid.innerHTML = '';
+                
+                card = document.createElement('div');
+                card.className = 'container-card';
+                card.innerHTML = `
+                    <div class="container-status"></div>
+                    <div class="container-header">
+                        <div class="container-name"></div>
+                        <div class="container-ip"></div>
+                        <div class="container-image" style="color: #888; font-size: 12px; margin-top: 4px;"></div>
+                        <div class="container-usage" style="color: #00ffff; font-size: 12px; margin-top: 4px;"></div>
+                    </div>
+                    <div class="container-logs scrollbar" id="logs-${container.id}">
+                        <span class="loading-spinner"></span>Loading logs...
+                    </div>
+                `;
+                grid.appendChild(card);
+                containerCards.set(container.id, card);
+            }
+            
+            const status = card.querySelector('.container-status');
+            status.className = `container-status status-${container.status}`;
+            status.textContent = container.status.toUpperCase();
+            card.querySelector('.container-name').textContent = `📦 ${container.name}`;
+            card.querySelector('.container-ip').textContent = `🌐 ${container.ip}`;
+            card.querySelector('.container-image').textContent = container.image;
+            renderContainerCount();
+            return added;
+        }
+        
+        function removeContainer(containerId) {
+            const card = containerCards.get(containerId);
+            if (!card) return;
+            card.remove();
+            containerCards.delete(containerId);
+            renderContainerCount();
+        }
+        
+        // One batched request covers the given cards, or every card when no ids are passed
+        function fetchContainerLogs(ids) {
+            const containerIds = ids || Array.from(containerCards.keys());
+            if (containerIds.length === 0) return;
+            fetch(ids ? `/containers/logs?tail=20&ids=${ids.join(',')}` : '/containers/logs?tail=20')
                 .then(response => response.json())
-                .then(data => {
-                    const logs = document.getElementById('systemLogs');
-                    // Clear existing logs except initial ones
-                    while (logs.children.length > 3) {
-                        logs.removeChild(logs.lastChild);
-                    }
-                    
-                    // Add server logs
-                    data.logs.forEach(log => {
-                        const logEntry = document.createElement('div');
-                        logEntry.className = `log-entry ${log.type}`;
-                        logEntry.innerHTML = `[${log.timestamp}] ${log.message}`;
-                        logs.appendChild(logEntry);
+                .then(logData => {
+                    containerIds.forEach(containerId => {
+                        const logDiv = document.getElementById(`logs-${containerId}`);
+                        if (!logDiv) return;
+                        const text = logData.logs[containerId];
+                        if (logData.errors[containerId]) {
+                            logDiv.innerHTML = '<span style="color: #ff6666;">Error loading logs</span>';
+                        } else if (text && text.trim()) {
+                            const logLines = text.split('\\n').filter(line => line.trim());
+                            logDiv.innerHTML = logLines.join('<br>');
+                        } else {
+                            logDiv.innerHTML = '<span style="color: #666;">No logs available yet...</span>';
+                        }
                     });
-                    
-                    logs.scrollTop = logs.scrollHeight;
                 })
-                .catch(error => {
-                    console.error('Error fetching system logs:', error);
+                .catch(() => {
+                    containerIds.forEach(containerId => {
+                        const logDiv = document.getElementById(`logs-${containerId}`);
+                        if (logDiv) logDiv.innerHTML = '<span style="color: #ff6666;">Error loading logs</span>';
+                    });
                 });
         }
         
-        function updateContainers() {
-            fetch('/containers')
+        function formatBytes(bytes) {
+            if (bytes === null || bytes === undefined) return '-';
+            const units = ['B', 'KB', 'MB', 'GB'];
+            let i = 0;
+            while (bytes >= 1024 && i < units.length - 1) { bytes /= 1024; i++; }
+            return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+        }
+        
+        function fetchContainerMetrics() {
+            if (containerCards.size === 0) return;
+            fetch('/metrics/containers')
                 .then(response => response.json())
                 .then(data => {
-                    const grid = document.getElementById('containersGrid');
-                    const count = document.getElementById('containerCount');
-                    
-                    // Filter out management container
-                    const containers = data.containers.filter(c => !c.name.includes('docker-lab-manager'));
-                    count.textContent = `(${containers.length})`;
-                    
-                    if (containers.length === 0) {
-                        grid.innerHTML = `
-                            <div style="text-align: center; color: #666; margin-top: 50px;">
-                                No containers deployed yet...<br>
-                                <small>Use API with password to deploy containers</small>
-                            </div>
-                        `;
-                        return;
-                    }
-                    
-                    grid.innerHTML = '';
-                    
-                    containers.forEach(container => {
-                        const card = document.createElement('div');
-                        card.className = 'container-card';
-                        card.innerHTML = `
-                            <div class="container-status status-${container.status}">
-                                ${container.status.toUpperCase()}
-                            </div>
-                            <div class="container-header">
-                                <div class="container-name">📦 ${container.name}</div>
-                                <div class="container-ip">🌐 ${container.ip}</div>
-                                <div style="color: #888; font-size: 12px; margin-top: 4px;">
-                                    ${container.image}
-                                </div>
-                            </div>
-                            <div class="container-logs scrollbar" id="logs-${container.id}">
-                                <span class="loading-spinner"></span>Loading logs...
-                            </div>
-                        `;
-                        grid.appendChild(card);
-                        
-                        // Fetch container logs
-                        fetch(`/containers/${container.id}/logs`)
-                            .then(response => response.json())
-                            .then(logData => {
-                                const logDiv = document.getElementById(`logs-${container.id}`);
-                                if (logDiv) {
-                                    if (logData.logs && logData.logs.trim()) {
-                                        const logLines = logData.logs.split('\\n').filter(line => line.trim());
-                                        const recentLogs = logLines.slice(-20); // Show last 20 lines
-                                        logDiv.innerHTML = recentLogs.join('<br>');
-                                    } else {
-                                        logDiv.innerHTML = '<span style="color: #666;">No logs available yet...</span>';
-                                    }
-                                }
-                            })
-                            .catch(() => {
-                                const logDiv = document.getElementById(`logs-${container.id}`);
-                                if (logDiv) logDiv.innerHTML = '<span style="color: #ff6666;">Error loading logs</span>';
-                            });
+                    containerCards.forEach((card, containerId) => {
+                        const usage = data.containers[containerId];
+                        const cpu = usage && usage.cpu_percent.current;
+                        card.querySelector('.container-usage').textContent = usage
+                            ? `⚙️ CPU ${cpu === null ? '-' : cpu.toFixed(1) + '%'} · 🧠 ${formatBytes(usage.memory.current)} (peak ${formatBytes(usage.memory.peak)})`
+                            : '';
                     });
                 })
-                .catch(error => {
-                    addLog(`Error fetching containers: ${error.message}`, 'error');
-                });
+                .catch(() => {});
         }
         
-        // Initial load and refresh
-        updateContainers();
-        updateSystemLogs();
+        // Subscribe once; the server pushes a snapshot followed by deltas
+        let eventSource = null;
+        let streamDown = false;
+        function connectEvents() {
+            eventSource = new EventSource('/events');
+            
+            eventSource.addEventListener('snapshot', event => {
+                const data = JSON.parse(event.data);
+                const live = new Set(data.containers.map(c => c.id));
+                Array.from(containerCards.keys()).filter(id => !live.has(id)).forEach(removeContainer);
+                // New cards from the snapshot share one batched log request
+                const added = data.containers.filter(upsertContainer).map(c => c.id);
+                if (added.length) fetchContainerLogs(added);
+                data.logs.forEach(appendSystemLog);
+                renderContainerCount();
+                if (streamDown) addLog('Event stream reconnected', 'info');
+                streamDown = false;
+            });
+            eventSource.addEventListener('log', event => appendSystemLog(JSON.parse(event.data)));
+            eventSource.addEventListener('container_added', event => {
+                const container = JSON.parse(event.data);
+                if (upsertContainer(container)) fetchContainerLogs([container.id]);
+            });
+            eventSource.addEventListener('container_updated', event => {
+                const container = JSON.parse(event.data);
+                if (upsertContainer(container)) fetchContainerLogs([container.id]);
+            });
+            eventSource.addEventListener('container_removed', event => removeContainer(JSON.parse(event.data).id));
+            eventSource.addEventListener('resync', () => {
+                eventSource.close();
+                connectEvents();
+            });
+            eventSource.onerror = () => {
+                if (!streamDown) addLog('Event stream disconnected, retrying...', 'warning');
+                streamDown = true;
+            };
+        }
         
-        // Refresh every 3 seconds for faster updates
-        setInterval(updateContainers, 3000);
-        setInterval(updateSystemLogs, 2000);
+        connectEvents();
+        
+        // Container logs refresh on a timer with a single batched request
+        setInterval(() => fetchContainerLogs(), 3000);
+        setInterval(fetchContainerMetrics, 10000);
         
         // Resize canvas on window resize
         window.addEventListener('resize', () => {
@@ -545,140 +2712,682 @@ DASHBOARD_HTML = '''
 </html>
 '''
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.trace, g.trace_token = start_trace(f"{request.method} {route}", path=request.path)
+
+def too_many_requests(message, retry_after, reason):
+    """429 response telling the client when to come back"""
+    REQUESTS_REJECTED.labels(reason).inc()
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def client_key():
+    """Who a request is rate limited as: a configured header if present, else the peer address"""
+    if RATE_LIMIT_CLIENT_HEADER and request.headers.get(RATE_LIMIT_CLIENT_HEADER):
+        return request.headers[RATE_LIMIT_CLIENT_HEADER].split(',')[0].strip()
+    return request.remote_addr
+
+@app.before_request
+def admit_request():
+    """Token bucket per client, then back-pressure from the Docker gate, on mutating routes"""
+    if request.method not in MUTATING_METHODS:
+        return None
+    wait = rate_limiter.take(client_key())
+    if wait:
+        return too_many_requests("Rate limit exceeded, slow down", math.ceil(wait), 'rate_limit')
+    if docker_gate.saturated:
+        add_system_log("⚠️ Docker is saturated, turning a request away", 'warning')
+        return too_many_requests("Docker is busy, try again later", docker_gate.retry_after(), 'docker_busy')
+    return None
+
+def wants_wait():
+    data = request.get_json(silent=True)
+    return isinstance(data, dict) and bool(data.get('wait'))
+
+def holds_stream(view=None, when=None):
+    """Route decorator: a long-lived response takes one of MAX_STREAMS slots, 503 when none is free"""
+    if view is None:
+        return lambda view: holds_stream(view, when)
+    
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if when is not None and not when():
+            return view(*args, **kwargs)
+        if not stream_slots.acquire(blocking=False):
+            REQUESTS_REJECTED.labels('streams').inc()
+            response = jsonify({"error": "Too many open streams, try again later", "retry_after": STREAM_RETRY_AFTER})
+            response.headers['Retry-After'] = str(STREAM_RETRY_AFTER)
+            return response, 503
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            stream_slots.release()
+            raise
+        # A streamed body keeps the slot until the server closes it (done or client gone)
+        if response.is_streamed:
+            response.call_on_close(stream_slots.release)
+        else:
+            stream_slots.release()
+        return response
+    return wrapper
+
+@app.after_request
+def record_request_metrics(response):
+    """Per-route latency; streaming responses are timed until their first byte is ready"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if 'request_started' in g:
+        REQUEST_SECONDS.labels(route, request.method).observe(time.time() - g.request_started)
+    REQUESTS_TOTAL.labels(route, request.method, str(response.status_code)).inc()
+    
+    if 'trace' in g:
+        finish_trace(g.trace, g.trace_token)
+        # Only requests that reached Docker are worth keeping
+        if g.trace.spans:
+            trace_buffer.add(g.trace)
+        if request.args.get('timing') == '1' and response.is_json and not response.is_streamed:
+            body = response.get_json()
+            if isinstance(body, dict):
+                body['timing'] = g.trace.to_dict()
+                response.set_data(app.json.dumps(body))
+        del g.trace
+    return response
+
+@app.route('/debug/traces', methods=['GET'])
+def list_traces():
+    """Recent traces plus a per-span profile; ?sort=duration puts the slowest first"""
+    limit = max(0, min(request.args.get('limit', 50, type=int), TRACE_BUFFER_SIZE))
+    name = request.args.get('name')
+    min_ms = request.args.get('min_ms', 0, type=float)
+    traces = [trace.to_dict() for trace in reversed(trace_buffer.recent())]
+    if name:
+        traces = [trace for trace in traces if trace['name'] == name]
+    if min_ms:
+        traces = [trace for trace in traces if (trace['duration_ms'] or 0) >= min_ms]
+    if request.args.get('sort') == 'duration':
+        traces.sort(key=lambda trace: trace['duration_ms'] or 0, reverse=True)
+    
+    # Where the time goes across every matching trace, by span name
+    profile = {}
+    for trace in traces:
+        for span in trace['spans']:
+            entry = profile.setdefault(span['name'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] += span['duration_ms']
+            entry['max_ms'] = max(entry['max_ms'], span['duration_ms'])
+    for entry in profile.values():
+        entry['avg_ms'] = round(entry['total_ms'] / entry['count'], 3)
+        entry['total_ms'] = round(entry['total_ms'], 3)
+    
+    return jsonify({
+        "traces": traces[:limit],
+        "profile": dict(sorted(profile.items(), key=lambda item: item[1]['total_ms'], reverse=True))
+    })
+
+@app.route('/debug/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """One trace with all of its spans"""
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify({"trace": trace.to_dict()})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text exposition of manager metrics"""
+    managers = [host.network_manager for host in hosts.values() if host.network_manager]
+    IP_POOL_CAPACITY.set(sum(manager.capacity for manager in managers))
+    IP_POOL_IN_USE.set(sum(manager.in_use for manager in managers))
+    NETWORK_SHARDS.set(sum(len(manager.shards) for manager in managers))
+    CONTAINERS_TRACKED.set(len(containers))
+    DOCKER_GATE_ACTIVE.set(docker_gate.active)
+    DOCKER_GATE_WAITING.set(docker_gate.waiting)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/', methods=['GET'])
 def dashboard():
     """Serve the dashboard"""
-    return render_template_string(DASHBOARD_HTML, password=API_PASSWORD)
+    return render_template_string(DASHBOARD_HTML, password=API_PASSWORD, supernet=LAB_SUPERNET,
+                                  shard_prefix=LAB_SHARD_PREFIX, port=LAB_PORT)
 
 @app.route('/system-logs', methods=['GET'])
 def get_system_logs():
-    """Get system logs for dashboard"""
-    with log_lock:
-        return jsonify({"logs": system_logs})
+    """Get system logs for dashboard; ?since=<id>&type=error,warning&limit=N filter them"""
+    since = request.args.get('since', 0, type=int)
+    types = set(filter(None, request.args.get('type', '').split(','))) or None
+    limit = request.args.get('limit', type=int)
+    logs = system_log_buffer.since(since, types, limit)
+    return jsonify({"logs": logs, "last_id": system_log_buffer.last_id})
+
+@app.route('/events', methods=['GET'])
+@holds_stream
+def stream_events():
+    """Server-Sent Events feed of system logs and container changes"""
+    # Subscribe before taking the snapshot so no delta is missed
+    subscription = event_hub.subscribe()
+    with containers_lock:
+        snapshot = {'containers': list(containers.values())}
+    snapshot['logs'] = system_log_buffer.since(limit=100)
+    snapshot = json.dumps(snapshot)
+    
+    def generate():
+        try:
+            yield f"event: snapshot\ndata: {snapshot}\n\n"
+            while True:
+                try:
+                    seq, event_type, payload = subscription.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {seq}\nevent: {event_type}\ndata: {payload}\n\n"
+        finally:
+            event_hub.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "containers": len(containers)})
+    return jsonify({
+        "status": "healthy",
+        "containers": len(containers),
+        "hosts": {name: {"healthy": host.healthy, "load": host.load} for name, host in hosts.items()},
+        "event_stream": {name: host.event_stream for name, host in hosts.items()},
+        "sse_subscribers": event_hub.subscriber_count,
+        "image_cache": {name: host.image_cache.snapshot() for name, host in hosts.items()},
+        "warm_pools": {
+            "hits": sum(pool.hits for pool in warm_pools.values()),
+            "misses": sum(pool.misses for pool in warm_pools.values())
+        },
+        "reaper": {
+            "scheduled": reaper.pending(),
+            "next_deadline": reaper.next_deadline()
+        },
+        "admission": {
+            "docker_gate": docker_gate.snapshot(),
+            "rate_limit": rate_limiter.snapshot()
+        }
+    })
 
 @app.route('/deploy', methods=['POST'])
 def deploy_container():
-    """Deploy a new container with unique IP - requires password"""
+    """Queue a new container deployment - requires password"""
+    data = request.get_json()
+    
+    # Check password
+    if not data or data.get('password') != API_PASSWORD:
+        add_system_log("❌ Unauthorized deployment attempt", 'error')
+        return jsonify({"error": "Invalid password"}), 401
+    
+    # Validate required fields
+    if 'image' not in data:
+        return jsonify({"error": "Missing 'image' field"}), 400
+    
+    pull_policy = data.get('pull_policy', DEFAULT_PULL_POLICY)
+    if pull_policy not in PULL_POLICIES:
+        return jsonify({"error": f"'pull_policy' must be one of {', '.join(PULL_POLICIES)}"}), 400
+    
+    profile = data.get('profile', 'default')
+    if not isinstance(profile, str) or profile not in DEPLOY_PROFILES:
+        return jsonify({"error": f"Unknown profile '{profile}'"}), 400
     try:
-        data = request.get_json()
-        
-        # Check password
-        if not data or data.get('password') != API_PASSWORD:
-            add_system_log("❌ Unauthorized deployment attempt", 'error')
-            return jsonify({"error": "Invalid password"}), 401
-        
-        # Validate required fields
-        if 'image' not in data:
-            return jsonify({"error": "Missing 'image' field"}), 400
-        
-        image = data['image']
-        name = data.get('name', f"lab-container-{int(time.time())}")
-        environment = data.get('environment', {})
-        volumes = data.get('volumes', {})
-        command = data.get('command')
-        
-        add_system_log(f"🚀 Starting deployment: {name}", 'deployment')
-        add_system_log(f"📥 Pulling image: {image}", 'deployment')
-        
-        # Pull image first to show progress
-        try:
-            add_system_log(f"⬇️ Downloading {image}...", 'deployment')
-            client.images.pull(image)
-            add_system_log(f"✅ Image {image} pulled successfully", 'deployment')
-        except Exception as pull_error:
-            add_system_log(f"⚠️ Using cached image or pull failed: {str(pull_error)}", 'warning')
-        
-        add_system_log(f"🏗️ Creating container: {name}", 'deployment')
-        
-        # Create container without port mapping
-        container = client.containers.run(
-            image=image,
-            name=name,
-            environment=environment,
-            volumes=volumes,
-            command=command,
-            network=network_manager.network_name,
-            detach=True,
-            remove=False
-        )
-        
-        add_system_log(f"🔧 Configuring network for: {name}", 'deployment')
-        
-        # Get container IP
-        container.reload()
-        container_ip = container.attrs['NetworkSettings']['Networks'][network_manager.network_name]['IPAddress']
-        
-        # Get exposed ports from container (for info only)
-        exposed_ports = []
-        if container.attrs.get('Config', {}).get('ExposedPorts'):
-            exposed_ports = list(container.attrs['Config']['ExposedPorts'].keys())
-        
-        # Store container info
-        container_info = {
-            'id': container.id,
-            'name': name,
-            'image': image,
-            'ip': container_ip,
-            'status': container.status,
-            'exposed_ports': exposed_ports,
-            'created': time.time(),
-            'access_url': f"http://{container_ip}" if '80/tcp' in exposed_ports else None
+        tenant = parse_tenant(data)
+        ttl, idle_timeout = parse_lifetime(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    placement_error = validate_placement(data)
+    if placement_error:
+        return jsonify({"error": placement_error}), 400
+    
+    if pending_job_count() >= MAX_PENDING_JOBS:
+        add_system_log("⚠️ Deploy queue full, rejecting request", 'warning')
+        return too_many_requests("Deploy queue is full, try again later", deploy_retry_after(), 'deploy_queue')
+    
+    # Quotas are checked against running counters before Docker is touched
+    quota_error = reserve_quota(tenant, [profile])
+    if quota_error:
+        add_system_log(f"⛔ Deployment rejected: {quota_error}", 'warning')
+        return jsonify({"error": quota_error}), 403
+    
+    spec = {
+        'image': data['image'],
+        'name': data.get('name', f"lab-container-{int(time.time())}"),
+        'environment': data.get('environment', {}),
+        'volumes': data.get('volumes', {}),
+        'command': data.get('command'),
+        'profile': profile,
+        'tenant': tenant,
+        'ttl': ttl,
+        'idle_timeout': idle_timeout,
+        'host': data.get('host'),
+        'host_tags': data.get('host_tags'),
+        'placement': data.get('placement'),
+        'pull_policy': pull_policy
+    }
+    job = create_job({'image': spec['image'], 'name': spec['name']})
+    deploy_executor.submit(run_deploy_job, job, spec)
+    
+    add_system_log(f"📋 Deployment queued: {spec['name']} (job {job['id']})", 'deployment')
+    
+    response = jsonify({
+        "success": True,
+        "job_id": job['id'],
+        "status": job['status'],
+        "status_url": f"/jobs/{job['id']}"
+    })
+    response.headers['Location'] = f"/jobs/{job['id']}"
+    return response, 202
+
+@app.route('/deploy/batch', methods=['POST'])
+@holds_stream(when=wants_wait)
+def deploy_batch():
+    """Queue a classroom batch: one pull per image, then parallel create/start - requires password"""
+    data = request.get_json()
+    
+    # Check password once for the whole batch
+    if not data or data.get('password') != API_PASSWORD:
+        add_system_log("❌ Unauthorized batch deployment attempt", 'error')
+        return jsonify({"error": "Invalid password"}), 401
+    
+    try:
+        count = int(data.get('count', 0))
+        parallelism = max(1, min(int(data.get('parallelism', BATCH_PARALLELISM)), BATCH_PARALLELISM))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'count' and 'parallelism' must be integers"}), 400
+    seats = data.get('seats')
+    if seats is None:
+        seats = [{}] * max(0, min(count, BATCH_MAX_SEATS + 1))
+    if not isinstance(seats, list) or not seats:
+        return jsonify({"error": "Provide 'count' or a non-empty 'seats' list"}), 400
+    if len(seats) > BATCH_MAX_SEATS:
+        return jsonify({"error": f"Batch exceeds {BATCH_MAX_SEATS} seats"}), 400
+    if not isinstance(data.get('environment') or {}, dict):
+        return jsonify({"error": "'environment' must be an object"}), 400
+    
+    pull_policy = data.get('pull_policy', DEFAULT_PULL_POLICY)
+    if pull_policy not in PULL_POLICIES:
+        return jsonify({"error": f"'pull_policy' must be one of {', '.join(PULL_POLICIES)}"}), 400
+    
+    try:
+        tenant = parse_tenant(data)
+        ttl, idle_timeout = parse_lifetime(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    placement_error = validate_placement(data)
+    if placement_error:
+        return jsonify({"error": placement_error}), 400
+    
+    prefix = data.get('name_prefix', f"lab-seat-{int(time.time())}")
+    specs = []
+    for index, seat in enumerate(seats, start=1):
+        if not isinstance(seat, dict) or not isinstance(seat.get('environment') or {}, dict):
+            return jsonify({"error": f"Seat {index} must be an object with an object 'environment'"}), 400
+        spec = {
+            'image': seat.get('image', data.get('image')),
+            'name': seat.get('name', f"{prefix}-{index:03d}"),
+            'environment': {**(data.get('environment') or {}), **(seat.get('environment') or {})},
+            'volumes': seat.get('volumes', data.get('volumes', {})),
+            'command': seat.get('command', data.get('command')),
+            'profile': seat.get('profile', data.get('profile', 'default')),
+            'tenant': tenant,
+            'ttl': ttl,
+            'idle_timeout': idle_timeout,
+            'host': data.get('host'),
+            'host_tags': data.get('host_tags'),
+            'placement': data.get('placement')
         }
-        containers[container.id] = container_info
-        
-        add_system_log(f"✅ Container {name} deployed successfully", 'deployment')
-        add_system_log(f"🌐 IP assigned: {container_ip}", 'deployment')
-        
-        if exposed_ports:
-            add_system_log(f"🔌 Exposed ports: {', '.join(exposed_ports)}", 'info')
-        
-        return jsonify({
-            "success": True,
-            "container": container_info,
-            "message": f"Container accessible at IP {container_ip}"
-        }), 201
-        
-    except docker.errors.ImageNotFound:
-        add_system_log(f"❌ Image '{image}' not found", 'error')
-        return jsonify({"error": f"Image '{image}' not found"}), 404
-    except Exception as e:
-        add_system_log(f"❌ Deployment failed: {str(e)}", 'error')
-        return jsonify({"error": str(e)}), 500
+        if not spec['image']:
+            return jsonify({"error": f"Missing 'image' for seat {index}"}), 400
+        if not isinstance(spec['profile'], str) or spec['profile'] not in DEPLOY_PROFILES:
+            return jsonify({"error": f"Unknown profile '{spec['profile']}' for seat {index}"}), 400
+        specs.append(spec)
+    
+    if pending_job_count() >= MAX_PENDING_JOBS:
+        add_system_log("⚠️ Deploy queue full, rejecting batch", 'warning')
+        return too_many_requests("Deploy queue is full, try again later", deploy_retry_after(), 'deploy_queue')
+    
+    # The whole batch must fit the tenant's quota up front
+    quota_error = reserve_quota(tenant, [spec['profile'] for spec in specs])
+    if quota_error:
+        add_system_log(f"⛔ Batch rejected: {quota_error}", 'warning')
+        return jsonify({"error": quota_error}), 403
+    
+    job = create_job(
+        {'images': sorted({spec['image'] for spec in specs}), 'count': len(specs)},
+        kind='batch',
+        pulls={},
+        seats=[{'name': spec['name'], 'status': 'queued', 'phases': {}, 'container': None, 'error': None}
+               for spec in specs]
+    )
+    future = deploy_executor.submit(run_batch_job, job, specs, parallelism, pull_policy)
+    
+    add_system_log(f"📋 Batch deployment queued: {len(specs)} containers (job {job['id']})", 'deployment')
+    
+    # Callers that want the timings inline can block until the batch is done
+    if data.get('wait'):
+        future.result()
+        with jobs_lock:
+            succeeded = job['status'] == 'succeeded'
+            return jsonify({"success": succeeded, "job": job}), 201 if succeeded else 500
+    
+    response = jsonify({
+        "success": True,
+        "job_id": job['id'],
+        "status": job['status'],
+        "status_url": f"/jobs/{job['id']}"
+    })
+    response.headers['Location'] = f"/jobs/{job['id']}"
+    return response, 202
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Deploy profiles and their resource limits"""
+    return jsonify({"profiles": DEPLOY_PROFILES})
+
+@app.route('/quotas', methods=['GET'])
+def get_quotas():
+    """Per-tenant quota usage and limits"""
+    return jsonify(quota_tracker.snapshot())
+
+@app.route('/hosts', methods=['GET'])
+def list_hosts():
+    """Docker hosts with health, load and capacity"""
+    return jsonify({
+        "strategy": PLACEMENT_STRATEGY,
+        "hosts": [host.snapshot() for host in hosts.values()]
+    })
+
+@app.route('/networks', methods=['GET'])
+def list_networks():
+    """Network shards with their address usage, per Docker host"""
+    return jsonify({
+        "hosts": {name: host.network_manager.snapshot() for name, host in hosts.items() if host.network_manager}
+    })
+
+@app.route('/pools', methods=['GET'])
+def list_pools():
+    """Warm pool sizes and hit/miss counters"""
+    return jsonify({"pools": [pool.snapshot() for pool in list(warm_pools.values())]})
+
+@app.route('/pools', methods=['POST'])
+def configure_pool():
+    """Create or resize a warm pool - requires password"""
+    data = request.get_json()
+    
+    # Check password
+    if not data or data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    try:
+        validate_pool_config(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    pool = configure_warm_pool(data)
+    add_system_log(f"♨️ Warm pool {pool.name} set to {pool.size} containers", 'info')
+    return jsonify({"success": True, "pool": pool.snapshot()})
+
+@app.route('/templates', methods=['GET'])
+def list_templates():
+    """Registered lab templates"""
+    with labs_lock:
+        return jsonify({"templates": sorted(lab_templates.values(), key=lambda t: t['name'])})
+
+@app.route('/templates/<name>', methods=['GET'])
+def get_template(name):
+    template = lab_templates.get(name)
+    if template is None:
+        return jsonify({"error": "Template not found"}), 404
+    return jsonify({"template": template})
+
+@app.route('/templates', methods=['POST'])
+def create_template():
+    """Register or replace a lab template - requires password"""
+    data = request.get_json()
+    
+    if not data or data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    try:
+        template = register_template(data.get('name'), data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    add_system_log(f"🧩 Lab template {template['name']} registered ({len(template['services'])} services)", 'info')
+    return jsonify({"success": True, "template": template}), 201
+
+@app.route('/templates/<name>', methods=['DELETE'])
+def delete_template(name):
+    """Unregister a lab template; running labs are not affected - requires password"""
+    data = request.get_json() or {}
+    
+    if data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    with labs_lock:
+        if lab_templates.pop(name, None) is None:
+            return jsonify({"error": "Template not found"}), 404
+    if registry:
+        registry.delete_template(name)
+    add_system_log(f"🧩 Lab template {name} removed", 'info')
+    return jsonify({"success": True})
+
+@app.route('/labs', methods=['POST'])
+@holds_stream(when=wants_wait)
+def deploy_lab():
+    """Queue a lab: every service of a template on private networks, in dependency order - requires password"""
+    data = request.get_json()
+    
+    if not data or data.get('password') != API_PASSWORD:
+        add_system_log("❌ Unauthorized lab deployment attempt", 'error')
+        return jsonify({"error": "Invalid password"}), 401
+    
+    template = lab_templates.get(data['template']) if isinstance(data.get('template'), str) else None
+    if template is None:
+        return jsonify({"error": f"Unknown template '{data.get('template')}'"}), 400
+    if not isinstance(data.get('environment') or {}, dict):
+        return jsonify({"error": "'environment' must be an object"}), 400
+    
+    pull_policy = data.get('pull_policy', DEFAULT_PULL_POLICY)
+    if pull_policy not in PULL_POLICIES:
+        return jsonify({"error": f"'pull_policy' must be one of {', '.join(PULL_POLICIES)}"}), 400
+    
+    try:
+        tenant = parse_tenant(data)
+        ttl, idle_timeout = parse_lifetime(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    placement_error = validate_placement(data)
+    if placement_error:
+        return jsonify({"error": placement_error}), 400
+    
+    if pending_job_count() >= MAX_PENDING_JOBS:
+        add_system_log("⚠️ Deploy queue full, rejecting lab", 'warning')
+        return too_many_requests("Deploy queue is full, try again later", deploy_retry_after(), 'deploy_queue')
+    
+    lab_id = uuid.uuid4().hex[:12]
+    lab_name = data.get('name', f"{template['name']}-{lab_id[:6]}")
+    if not isinstance(lab_name, str) or not LAB_NAME_PATTERN.fullmatch(lab_name):
+        return jsonify({"error": f"Invalid lab name '{lab_name}'"}), 400
+    
+    specs = {}
+    for service, config in template['services'].items():
+        specs[service] = {
+            'image': config['image'],
+            'name': f"{lab_name}-{service}",
+            'environment': {**config['environment'], **(data.get('environment') or {})},
+            'volumes': config['volumes'],
+            'command': config['command'],
+            'profile': config['profile'],
+            'tenant': tenant,
+            # Members live and die with their lab, which carries the TTL and idle timeout
+            'ttl': 0,
+            'idle_timeout': 0,
+            'lab': lab_id,
+            'service': service,
+            'networks': config['networks'],
+            'expose': config['expose'],
+            'labels': {LAB_LABEL: lab_id, SERVICE_LABEL: service}
+        }
+    
+    # The whole lab must fit the tenant's quota up front
+    quota_error = reserve_quota(tenant, [spec['profile'] for spec in specs.values()])
+    if quota_error:
+        add_system_log(f"⛔ Lab rejected: {quota_error}", 'warning')
+        return jsonify({"error": quota_error}), 403
+    
+    lab = {
+        'id': lab_id,
+        'name': lab_name,
+        'template': template['name'],
+        'tenant': tenant,
+        'host': None,
+        'placement': {key: data.get(key) for key in ('host', 'host_tags', 'placement')},
+        'status': 'deploying',
+        'networks': {},
+        'services': {},
+        'created': time.time(),
+        'ttl': ttl,
+        'idle_timeout': idle_timeout
+    }
+    job = create_job(
+        {'template': template['name'], 'lab': lab_id, 'name': lab_name},
+        kind='lab',
+        pulls={},
+        services={service: {'name': spec['name'], 'status': 'queued', 'phases': {}, 'container': None, 'error': None}
+                  for service, spec in specs.items()}
+    )
+    save_lab(lab, job_id=job['id'])
+    with labs_lock:
+        labs[lab_id] = lab
+    future = deploy_executor.submit(run_lab_job, job, lab, template, specs, pull_policy)
+    
+    add_system_log(f"📋 Lab {lab_name} queued: {len(specs)} services (job {job['id']})", 'deployment')
+    
+    if data.get('wait'):
+        future.result()
+        with jobs_lock:
+            succeeded = job['status'] == 'succeeded'
+        return jsonify({"success": succeeded, "job": job, "lab": lab_snapshot(lab)}), 201 if succeeded else 500
+    
+    response = jsonify({
+        "success": True,
+        "lab_id": lab_id,
+        "job_id": job['id'],
+        "status": job['status'],
+        "status_url": f"/jobs/{job['id']}",
+        "lab_url": f"/labs/{lab_id}"
+    })
+    response.headers['Location'] = f"/labs/{lab_id}"
+    return response, 202
+
+@app.route('/labs', methods=['GET'])
+def list_labs():
+    """All labs with their status and member containers"""
+    with labs_lock:
+        records = list(labs.values())
+    return jsonify({"labs": [lab_snapshot(lab) for lab in records]})
+
+@app.route('/labs/<lab_id>', methods=['GET'])
+def get_lab(lab_id):
+    lab = labs.get(lab_id)
+    if lab is None:
+        return jsonify({"error": "Lab not found"}), 404
+    return jsonify({"lab": lab_snapshot(lab)})
+
+@app.route('/labs/<lab_id>', methods=['DELETE'])
+def remove_lab(lab_id):
+    """Remove every container and network of a lab - requires password"""
+    data = request.get_json() or {}
+    
+    if data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    lab = labs.get(lab_id)
+    if lab is None:
+        return jsonify({"error": "Lab not found"}), 404
+    if lab['status'] in ('deploying', 'removing'):
+        return jsonify({"error": f"Lab is {lab['status']}, try again later"}), 409
+    host = hosts.get(lab['host'])
+    if host is None or not host.available:
+        return jsonify({"error": f"Docker host {lab['host']} is unavailable"}), 503
+    
+    add_system_log(f"🗑️ Removing lab: {lab['name']}", 'warning')
+    errors = teardown_lab(lab)
+    if errors:
+        return jsonify({"error": "Some lab containers could not be removed", "failed": errors}), 500
+    return jsonify({"success": True, "message": "Lab removed"})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get deploy job status with per-phase timings"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        response = {"job": job}
+        # ?timing=1 also returns the worker's trace for this job
+        if request.args.get('timing') == '1' and job.get('trace_id'):
+            trace = trace_buffer.get(job['trace_id'])
+            response['trace'] = trace.to_dict() if trace else None
+        return jsonify(response)
 
 @app.route('/containers', methods=['GET'])
 def list_containers():
-    """List all managed containers"""
-    # Refresh container status
-    for container_id in list(containers.keys()):
-        try:
-            container = client.containers.get(container_id)
-            containers[container_id]['status'] = container.status
-        except docker.errors.NotFound:
-            # Container was removed externally
-            container_info = containers.pop(container_id)
-            if network_manager:
-                network_manager.release_ip(container_info['ip'])
-    
-    return jsonify({"containers": list(containers.values())})
+    """List all managed containers"""
+    # Status is kept current by the Docker event watcher; ?refresh=1 forces a resync
+    unreachable = []
+    if request.args.get('refresh') == '1':
+        # Every host is listed concurrently; one slow daemon does not serialise the rest
+        results = for_each_host(reconcile_containers)
+        unreachable = sorted(name for name, result in results.items() if isinstance(result, Exception))
+        unreachable += sorted(name for name, host in hosts.items() if not host.available)
+    with containers_lock:
+        records = list(containers.values())
+    # ?stats=1 attaches the sampler's latest usage summary to each record
+    if request.args.get('stats') == '1':
+        summaries = stats_sampler.summaries()
+        records = [{**info, 'usage': summaries.get(info['id'])} for info in records]
+    if unreachable:
+        return jsonify({"containers": records, "unreachable_hosts": unreachable})
+    return jsonify({"containers": records})
+
+@app.route('/metrics/containers', methods=['GET'])
+def container_metrics():
+    """CPU, memory and network summaries for all sampled containers"""
+    summaries = stats_sampler.summaries()
+    with containers_lock:
+        metrics = {
+            cid: {'name': containers[cid]['name'], **summary}
+            for cid, summary in summaries.items() if cid in containers
+        }
+    return jsonify({"containers": metrics, "sampler": stats_sampler.snapshot()})
+
+@app.route('/metrics/containers/<container_id>', methods=['GET'])
+def container_metrics_detail(container_id):
+    """Usage summary plus the raw rolling windows for one container"""
+    if container_id not in containers:
+        return jsonify({"error": "Container not found"}), 404
+    summary = stats_sampler.summary(container_id)
+    if summary is None:
+        return jsonify({"error": "No samples yet"}), 404
+    return jsonify({"id": container_id, **summary, "series": stats_sampler.series(container_id)})
 
 @app.route('/containers/<container_id>', methods=['GET'])
 def get_container(container_id):
     """Get specific container info"""
-    if container_id not in containers:
+    container_info = containers.get(container_id)
+    if container_info is None:
         return jsonify({"error": "Container not found"}), 404
     
-    try:
-        container = client.containers.get(container_id)
-        containers[container_id]['status'] = container.status
-        return jsonify({"container": containers[container_id]})
-    except docker.errors.NotFound:
-        containers.pop(container_id, None)
-        return jsonify({"error": "Container not found"}), 404
+    return jsonify({"container": container_info})
 
 @app.route('/containers/<container_id>', methods=['DELETE'])
 def remove_container(container_id):
@@ -693,27 +3402,133 @@ def remove_container(container_id):
         return jsonify({"error": "Container not found"}), 404
     
     try:
-        container = client.containers.get(container_id)
+        # Ownership is known from the registry, no inspect needed before removal
+        container = container_client(container_id).containers.prepare_model({'Id': container_id})
         container_name = containers[container_id]['name']
         
         add_system_log(f"🗑️ Removing container: {container_name}", 'warning')
-        container.remove(force=True)
+        docker_gate.call(container.remove, force=True)
         
         # Release IP and remove from tracking
-        container_info = containers.pop(container_id)
-        network_manager.release_ip(container_info['ip'])
+        forget_container(container_id)
         
         add_system_log(f"✅ Container {container_name} removed successfully", 'info')
         
         return jsonify({"success": True, "message": "Container removed"})
         
     except docker.errors.NotFound:
-        containers.pop(container_id, None)
+        forget_container(container_id)
         return jsonify({"error": "Container not found"}), 404
     except Exception as e:
         add_system_log(f"❌ Error removing container: {str(e)}", 'error')
         return jsonify({"error": str(e)}), 500
 
+@app.route('/containers/<container_id>/keepalive', methods=['POST'])
+def keepalive_container(container_id):
+    """Mark a container active and optionally extend its TTL - requires password"""
+    data = request.get_json() or {}
+    
+    if data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    container_info = containers.get(container_id)
+    if container_info is None:
+        return jsonify({"error": "Container not found"}), 404
+    
+    try:
+        ttl, _ = parse_lifetime(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    fields = {'last_active': time.time()}
+    if ttl is not None:
+        fields['expires_at'] = time.time() + ttl if ttl else None
+    # A lab member keeps its whole lab alive
+    lab = labs.get(container_info.get('lab'))
+    if lab is not None:
+        save_lab(lab, **fields)
+        if fields.get('expires_at'):
+            reaper.schedule(fields['expires_at'], expire_lab, lab['id'], fields['expires_at'])
+        return jsonify({"success": True, "container": container_info, "lab": lab_snapshot(lab)})
+    set_container_fields(container_id, **fields)
+    if fields.get('expires_at'):
+        reaper.schedule(fields['expires_at'], expire_container, container_id, fields['expires_at'])
+    
+    return jsonify({"success": True, "container": containers.get(container_id, container_info)})
+
+@app.route('/containers/<container_id>/snapshot', methods=['POST'])
+def snapshot_container_route(container_id):
+    """Commit a container's current state as its reset point - requires password"""
+    data = request.get_json() or {}
+    
+    if data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    container_info = containers.get(container_id)
+    if container_info is None:
+        return jsonify({"error": "Container not found"}), 404
+    
+    try:
+        started = time.time()
+        snapshot = snapshot_container(container_info, pause=data.get('pause', True))
+    except docker.errors.NotFound:
+        forget_container(container_id)
+        return jsonify({"error": "Container not found"}), 404
+    except Exception as e:
+        add_system_log(f"❌ Snapshot of {container_info['name']} failed: {str(e)}", 'error')
+        return jsonify({"error": str(e)}), 500
+    
+    elapsed = round(time.time() - started, 3)
+    add_system_log(f"📸 Snapshot of {container_info['name']} saved as {snapshot['image']} in {elapsed}s", 'info')
+    return jsonify({"success": True, "snapshot": snapshot, "total": elapsed}), 201
+
+@app.route('/containers/<container_id>/reset', methods=['POST'])
+def reset_container_route(container_id):
+    """Recreate a container from its snapshot on the same IP - requires password"""
+    data = request.get_json() or {}
+    
+    if data.get('password') != API_PASSWORD:
+        return jsonify({"error": "Invalid password"}), 401
+    
+    container_info = containers.get(container_id)
+    if container_info is None:
+        return jsonify({"error": "Container not found"}), 404
+    
+    # 'snapshot' (default when one exists) or 'image' to go back to the base image
+    source = data.get('source', 'snapshot' if container_info.get('snapshot') else 'image')
+    if source not in ('snapshot', 'image'):
+        return jsonify({"error": "'source' must be 'snapshot' or 'image'"}), 400
+    if source == 'snapshot' and not container_info.get('snapshot'):
+        return jsonify({"error": "Container has no snapshot"}), 409
+    # Claimed atomically so a double click cannot run two resets on one container
+    with containers_lock:
+        if container_id in resetting:
+            return jsonify({"error": "Container is already being reset"}), 409
+        if container_id not in containers:
+            return jsonify({"error": "Container not found"}), 404
+        resetting[container_id] = container_info['name']
+    
+    add_system_log(f"♻️ Resetting {container_info['name']} from {source}", 'warning')
+    phases = {}
+    started = time.time()
+    try:
+        new_info = reset_container(container_info, phases, from_snapshot=(source == 'snapshot'))
+    except docker.errors.ImageNotFound:
+        # Checked before the old container is touched, so it is still running
+        if source == 'snapshot':
+            set_container_fields(container_id, snapshot=None)
+            return jsonify({"error": "Snapshot image is gone, take a new snapshot"}), 409
+        return jsonify({"error": f"Image '{container_info['image']}' not found"}), 409
+    except docker.errors.NotFound as e:
+        return jsonify({"error": e.explanation or str(e), "phases": phases}), 404
+    except Exception as e:
+        add_system_log(f"❌ Reset of {container_info['name']} failed: {str(e)}", 'error')
+        return jsonify({"error": str(e), "phases": phases}), 500
+    
+    elapsed = round(time.time() - started, 3)
+    add_system_log(f"✅ Container {new_info['name']} reset in {elapsed}s ({new_info['ip']})", 'info')
+    return jsonify({"success": True, "container": new_info, "source": source, "phases": phases, "total": elapsed})
+
 @app.route('/containers/<container_id>/logs', methods=['GET'])
 def get_container_logs(container_id):
     """Get container logs"""
@@ -721,74 +3536,1508 @@ def get_container_logs(container_id):
         return jsonify({"error": "Container not found"}), 404
     
     try:
-        container = client.containers.get(container_id)
-        logs = container.logs(tail=100).decode('utf-8', errors='ignore')
+        logs, _ = log_cache.get(container_id, 100)
         return jsonify({"logs": logs})
     except docker.errors.NotFound:
         return jsonify({"error": "Container not found"}), 404
     except Exception as e:
         return jsonify({"logs": f"Error retrieving logs: {str(e)}"})
 
+@app.route('/containers/<container_id>/logs/stream', methods=['GET'])
+@holds_stream
+def stream_container_logs(container_id):
+    """Follow container logs over SSE (default) or NDJSON, resumable from a cursor"""
+    if container_id not in containers:
+        return jsonify({"error": "Container not found"}), 404
+    
+    # EventSource sends the last seen id back as Last-Event-ID on reconnect
+    try:
+        cursor = parse_log_cursor(request.args.get('since') or request.headers.get('Last-Event-ID'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor, expected '<unix_ns>:<offset>'"}), 400
+    tail = max(0, min(request.args.get('tail', 100, type=int), LOG_FOLLOW_BACKLOG))
+    entries = follow_log_entries(container_id, cursor, tail)
+    
+    if request.args.get('format') == 'ndjson':
+        def generate_ndjson():
+            for message in entries:
+                yield '\n' if message is None else json.dumps(message) + '\n'
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+    
+    def generate_sse():
+        for message in entries:
+            if message is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {message['cursor']}\nevent: log\ndata: {json.dumps(message)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+    
+    return Response(generate_sse(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/containers/logs', methods=['GET'])
+def get_many_container_logs():
+    """Last N log lines for many containers in one response"""
+    tail = max(1, min(request.args.get('tail', 100, type=int), MAX_LOG_TAIL))
+    ids = request.args.get('ids')
+    with containers_lock:
+        if ids:
+            container_ids = [cid for cid in ids.split(',') if cid in containers]
+        else:
+            container_ids = list(containers.keys())
+    
+    logs, errors, cached = log_cache.get_many(container_ids, tail)
+    return jsonify({"logs": logs, "errors": errors, "cached": cached})
+
 @app.route('/cleanup', methods=['POST'])
+@holds_stream
 def cleanup_all():
-    """Remove all managed containers - requires password"""
+    """Remove all managed containers in parallel, streaming NDJSON progress - requires password"""
     data = request.get_json() or {}
     
     # Check password
     if data.get('password') != API_PASSWORD:
         return jsonify({"error": "Invalid password"}), 401
     
+    try:
+        parallelism = max(1, min(int(data.get('parallelism', CLEANUP_WORKERS)), CLEANUP_WORKERS))
+        timeout = float(data.get('timeout', CLEANUP_TIMEOUT))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'parallelism' and 'timeout' must be numbers"}), 400
+    if not timeout > 0:
+        return jsonify({"error": "'timeout' must be a positive number of seconds"}), 400
+    
     add_system_log("🧹 Starting cleanup of all containers", 'warning')
     
-    removed = []
-    for container_id in list(containers.keys()):
-        try:
-            container = client.containers.get(container_id)
-            container_name = containers[container_id]['name']
-            container.remove(force=True)
-            container_info = containers.pop(container_id)
-            network_manager.release_ip(container_info['ip'])
-            removed.append(container_name)
-            add_system_log(f"✅ Cleaned up: {container_name}", 'info')
-        except docker.errors.NotFound:
-            containers.pop(container_id, None)
+    # One labelled list call per host covers tracked containers and untracked leftovers
+    live, listed = {}, set()
+    for name, result in for_each_host(list_managed_containers).items():
+        if isinstance(result, Exception):
+            add_system_log(f"❌ Cleanup could not list host {name}: {str(result)}", 'error')
+            continue
+        live.update(result)
+        listed.add(name)
+    if not listed:
+        return jsonify({"error": "No Docker host could be listed"}), 500
+    
+    with containers_lock:
+        names = {cid: info['name'] for cid, info in containers.items()}
+        stale = [cid for cid, info in containers.items()
+                 if info.get('host', LAB_HOST_NAME) in listed and cid not in live]
+    forget_containers(stale)
+    
+    targets = {
+        cid: (container, names.get(cid) or (container.attrs.get('Names') or ['/' + cid[:12]])[0].lstrip('/'))
+        for cid, container in live.items()
+    }
+    return Response(stream_removals(targets, parallelism, timeout), mimetype='application/x-ndjson')
+
+def remove_managed_container(container, started_at):
+    """Worker: force-remove one container and return its latency"""
+    started_at[container.id] = time.time()
+    try:
+        docker_gate.call(container.remove, force=True)
+    except docker.errors.NotFound:
+        pass
+    return round(time.time() - started_at[container.id], 3)
+
+def stream_removals(targets, parallelism, timeout):
+    """Remove containers on a bounded pool, yielding one NDJSON line per result"""
+    started = time.time()
+    started_at = {}
+    removed, failed, latencies = [], [], {}
+    
+    executor = ThreadPoolExecutor(max_workers=min(parallelism, max(len(targets), 1)),
+                                  thread_name_prefix='cleanup')
+    futures = {
+        executor.submit(remove_managed_container, container, started_at): (cid, name)
+        for cid, (container, name) in targets.items()
+    }
+    pending = set(futures)
+    
+    while pending:
+        done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+        for future in done:
+            container_id, name = futures[future]
+            try:
+                latency = future.result()
+            except Exception as e:
+                failed.append({'id': container_id, 'name': name, 'error': str(e)})
+                add_system_log(f"❌ Cleanup of {name} failed: {str(e)}", 'error')
+                yield json.dumps({'event': 'failed', **failed[-1]}) + '\n'
+                continue
+            removed.append((container_id, name))
+            latencies[name] = latency
+            add_system_log(f"✅ Cleaned up: {name}", 'info')
+            yield json.dumps({'event': 'removed', 'id': container_id, 'name': name, 'latency': latency}) + '\n'
+        
+        # Per-container timeout counts from when a worker picked the removal up
+        now = time.time()
+        for future in [f for f in pending if now - started_at.get(futures[f][0], now) > timeout]:
+            pending.discard(future)
+            container_id, name = futures[future]
+            failed.append({'id': container_id, 'name': name, 'error': f"Timed out after {timeout}s"})
+            add_system_log(f"⚠️ Cleanup of {name} timed out", 'warning')
+            yield json.dumps({'event': 'failed', **failed[-1]}) + '\n'
+    
+    # Timed out removals keep running; the event watcher forgets them on destroy
+    executor.shutdown(wait=False)
+    forget_containers([cid for cid, _ in removed])
     
     add_system_log(f"🧹 Cleanup completed. Removed {len(removed)} containers", 'info')
-    return jsonify({"success": True, "removed": removed})
+    yield json.dumps({
+        'event': 'summary',
+        'success': not failed,
+        'removed': [name for _, name in removed],
+        'failed': failed,
+        'latencies': latencies,
+        'total_time': round(time.time() - started, 3)
+    }) + '\n'
+
+def cleanup_host(host):
+    """Reconcile one host and clean up its exited containers"""
+    # A single labelled list call, diffed in memory against the cache
+    live = reconcile_containers(host)
+    for container_id, container in live.items():
+        if container.status != 'exited':
+            continue
+        container_info = containers.get(container_id)
+        container_name = container_info['name'] if container_info else container_id[:12]
+        add_system_log(f"🔄 Auto-cleanup: {container_name} (exited)", 'info')
+        try:
+            docker_gate.call(container.remove)
+        except docker.errors.NotFound:
+            pass
+        forget_container(container_id)
 
 def cleanup_orphaned_containers():
-    """Background task to clean up orphaned containers"""
-    while True:
+    """Scheduled task: reconcile every host with Docker and clean up exited containers"""
+    started = time.time()
+    try:
+        for name, result in for_each_host(cleanup_host).items():
+            if isinstance(result, Exception):
+                add_system_log(f"❌ Cleanup error on {name}: {str(result)}", 'error')
+    except Exception as e:
+        add_system_log(f"❌ Cleanup error: {str(e)}", 'error')
+    finally:
+        CLEANUP_SECONDS.observe(time.time() - started)
+        reaper.schedule(time.time() + RECONCILE_INTERVAL, cleanup_orphaned_containers)
+
+def schedule_reaping(container_info):
+    """Put a tracked container's expiry and first idle check on the reaper heap"""
+    if container_info.get('expires_at'):
+        reaper.schedule(container_info['expires_at'], expire_container,
+                        container_info['id'], container_info['expires_at'])
+    if container_info.get('idle_timeout'):
+        with idle_samples_lock:
+            # One idle-check chain per container
+            if container_info['id'] in idle_samples:
+                return
+            idle_samples[container_info['id']] = None
+        reaper.schedule(time.time() + min(IDLE_CHECK_INTERVAL, container_info['idle_timeout']),
+                        check_idle_container, container_info['id'])
+
+def reap_container(container_id, reason):
+    """Force-remove a tracked container the reaper has given up on"""
+    container_info = containers.get(container_id)
+    if container_info is None:
+        return
+    add_system_log(f"⏰ Reaping {container_info['name']} ({reason})", 'warning')
+    try:
+        docker_gate.call(container_client(container_id).containers.prepare_model({'Id': container_id}).remove,
+                         force=True)
+    except docker.errors.NotFound:
+        pass
+    forget_container(container_id)
+
+def expire_container(container_id, expires_at):
+    """Reaper task: remove a container whose TTL has run out"""
+    container_info = containers.get(container_id)
+    # Stale heap entries (removed or extended containers) are skipped here
+    if container_info is None or container_info.get('expires_at') != expires_at:
+        return
+    reap_container(container_id, 'TTL expired')
+
+def sample_activity(container_id):
+    """Cumulative CPU seconds and network bytes from one stats snapshot"""
+    api = container_client(container_id).api
+    one_shot = True if docker.utils.version_gte(api.api_version, '1.41') else None
+    stats = api.stats(container_id, stream=False, one_shot=one_shot)
+    cpu = (stats.get('cpu_stats') or {}).get('cpu_usage', {}).get('total_usage', 0) / 1e9
+    networks = stats.get('networks') or {}
+    net = sum(n.get('rx_bytes', 0) + n.get('tx_bytes', 0) for n in networks.values())
+    return cpu, net
+
+def check_idle_container(container_id):
+    """Reaper task: compare CPU and network deltas since the last check, reap if idle too long"""
+    container_info = containers.get(container_id)
+    if container_info is None or not container_info.get('idle_timeout'):
+        with idle_samples_lock:
+            idle_samples.pop(container_id, None)
+        return
+    
+    now = time.time()
+    try:
+        sample = sample_activity(container_id)
+    except docker.errors.NotFound:
+        forget_container(container_id)
+        return
+    except Exception as e:
+        # A slow or failing daemon must not end this container's idle-check chain
+        add_system_log(f"⚠️ Idle check of {container_info['name']} failed: {str(e)}", 'warning')
+        reaper.schedule(now + IDLE_CHECK_INTERVAL, check_idle_container, container_id)
+        return
+    with idle_samples_lock:
+        previous = idle_samples.get(container_id)
+        idle_samples[container_id] = sample
+    
+    # Nothing can be judged idle before a first delta has been measured
+    if previous is None:
+        reaper.schedule(now + IDLE_CHECK_INTERVAL, check_idle_container, container_id)
+        return
+    cpu_delta, net_delta = sample[0] - previous[0], sample[1] - previous[1]
+    # Counters reset on restart, which counts as activity too
+    if cpu_delta < 0 or net_delta < 0 or cpu_delta >= IDLE_CPU_SECONDS or net_delta >= IDLE_NET_BYTES:
+        set_container_fields(container_id, last_active=now)
+    
+    idle_for = now - containers.get(container_id, container_info)['last_active']
+    if idle_for >= container_info['idle_timeout']:
+        reap_container(container_id, f"idle for {int(idle_for)}s")
+        return
+    remaining = container_info['idle_timeout'] - idle_for
+    reaper.schedule(now + min(IDLE_CHECK_INTERVAL, remaining), check_idle_container, container_id)
+
+def create_job(spec, kind='deploy', **fields):
+    """Register a queued deploy job"""
+    job = {
+        'id': uuid.uuid4().hex[:12],
+        'kind': kind,
+        'status': 'queued',
+        'spec': spec,
+        'phases': {},
+        'container': None,
+        'error': None,
+        'submitted': time.time(),
+        'started': None,
+        'finished': None,
+        **fields
+    }
+    with jobs_lock:
+        jobs[job['id']] = job
+        if registry:
+            registry.save_job(job)
+        # Drop the oldest finished jobs once history is full
+        if len(jobs) > MAX_JOB_HISTORY:
+            for old_id in [jid for jid, j in jobs.items() if j['finished']][:len(jobs) - MAX_JOB_HISTORY]:
+                del jobs[old_id]
+    return job
+
+def deploy_retry_after():
+    """Seconds until the deploy queue has likely drained enough to take another job"""
+    with jobs_lock:
+        durations = [job['finished'] - job['started'] for job in jobs.values() if job['finished'] and job['started']]
+        pending = sum(1 for job in jobs.values() if not job['finished'])
+    average = sum(durations[-50:]) / len(durations[-50:]) if durations else 5.0
+    return max(1, math.ceil((pending - MAX_PENDING_JOBS + 1) * average / DEPLOY_WORKERS))
+
+def pending_job_count():
+    """Number of deploy jobs not yet finished"""
+    with jobs_lock:
+        return sum(1 for job in jobs.values() if not job['finished'])
+
+def update_job(job, **fields):
+    """Update job fields under the jobs lock"""
+    with jobs_lock:
+        job.update(fields)
+        if registry:
+            registry.save_job(job)
+
+def timed_phase(phases, phase, func, *args, **kwargs):
+    """Run one deploy phase and record how long it took in phases"""
+    started = time.time()
+    try:
+        with trace_span(phase):
+            return func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - started
+        DEPLOY_PHASE_SECONDS.labels(phase).observe(elapsed)
+        with jobs_lock:
+            phases[phase] = round(elapsed, 3)
+
+def create_lab_container(host, spec, network_name, container_ip, aliases=None):
+    """Create (not start) a lab container pinned to container_ip on a network of host"""
+    # Low-level API: the high-level create() cannot set ipv4_address
+    response = host.client.api.create_container(
+        image=spec['image'],
+        name=spec['name'],
+        environment=spec['environment'],
+        command=spec['command'],
+        labels={
+            MANAGER_LABEL: MANAGER_ID,
+            **({IP_LABEL: container_ip} if container_ip else {}),
+            NETWORK_LABEL: network_name,
+            PROFILE_LABEL: spec['profile'],
+            **({TENANT_LABEL: spec['tenant']} if spec.get('tenant') else {}),
+            **spec.get('labels', {})
+        },
+        host_config=host.client.api.create_host_config(
+            binds=spec['volumes'] or None,
+            network_mode=network_name,
+            **profile_host_config(spec['profile'])
+        ),
+        networking_config=host.network_manager.networking_config(network_name, container_ip, aliases)
+    )
+    return host.client.containers.prepare_model({'Id': response['Id']})
+
+def pull_image(image, phases, phase='pull', policy='always', host=None):
+    """Make an image available on a host, falling back to its copy if the pull fails"""
+    host = host or local_host()
+    add_system_log(f"📥 Pulling image: {image}", 'deployment')
+    
+    # The image cache skips fresh images and coalesces concurrent pulls
+    try:
+        outcome = timed_phase(phases, phase, host.image_cache.ensure, image, policy)
+        if outcome == 'pulled':
+            add_system_log(f"✅ Image {image} pulled successfully", 'deployment')
+        else:
+            add_system_log(f"📦 Image {image} already available ({outcome})", 'deployment')
+    except Exception as pull_error:
+        add_system_log(f"⚠️ Using cached image or pull failed: {str(pull_error)}", 'warning')
+
+def launch_container(spec, phases, start=True, host=None):
+    """Place, allocate an IP, create and optionally start a container; returns container_info"""
+    if host is None:
+        host = timed_phase(phases, 'place', place_container, spec)
+    # Pick the address up front and hand it to Docker
+    try:
+        shard, container_ip = timed_phase(phases, 'network', host.network_manager.allocate,
+                                          shard_group(spec.get('tenant')))
+    except Exception:
+        release_placement(host)
+        raise
+    try:
+        container = timed_phase(phases, 'create', docker_gate.call, create_lab_container,
+                                host, spec, shard.name, container_ip)
+    except Exception:
+        host.network_manager.release_ip(container_ip)
+        release_placement(host)
+        raise
+    
+    # From here on a failure must not leave a running, untracked container holding the lease
+    try:
+        if start:
+            timed_phase(phases, 'start', docker_gate.call, container.start)
+        timed_phase(phases, 'reload', container.reload)
+        return new_container_info(container, spec, host, shard.name, container_ip)
+    except Exception:
+        remove_failed_container(container)
+        host.network_manager.release_ip(container_ip)
+        release_placement(host)
+        raise
+
+def remove_failed_container(container):
+    """Best-effort removal of a container whose setup failed; never raises"""
+    try:
+        container.remove(force=True)
+    except docker.errors.NotFound:
+        pass
+    except Exception as e:
+        add_system_log(f"⚠️ Could not remove failed container {container.id[:12]}: {str(e)}", 'warning')
+
+def new_container_info(container, spec, host, network_name, container_ip):
+    """container_info for a freshly created and reloaded container"""
+    # Get exposed ports from container (for info only)
+    exposed_ports = []
+    if container.attrs.get('Config', {}).get('ExposedPorts'):
+        exposed_ports = list(container.attrs['Config']['ExposedPorts'].keys())
+    
+    created = time.time()
+    return {
+        'id': container.id,
+        'name': spec['name'],
+        'image': spec['image'],
+        'ip': container_ip,
+        'network': network_name,
+        'host': host.name,
+        'status': container.status,
+        'exposed_ports': exposed_ports,
+        'created': created,
+        'access_url': f"http://{container_ip}" if '80/tcp' in exposed_ports else None,
+        'tenant': spec.get('tenant'),
+        'profile': spec['profile'],
+        'mem_limit': profile_memory(spec['profile']),
+        **({'lab': spec['lab'], 'service': spec['service']} if spec.get('lab') else {}),
+        **lifetime_fields(spec, created)
+    }
+
+def provision_container(spec, phases, host=None):
+    """Create, start and track one container, returning its container_info"""
+    name = spec['name']
+    add_system_log(f"🏗️ Creating container: {name}", 'deployment')
+    add_system_log(f"🔧 Configuring network for: {name}", 'deployment')
+    
+    container_info = launch_container(spec, phases, host=host)
+    track_container(container_info)
+    
+    add_system_log(f"✅ Container {name} deployed successfully", 'deployment')
+    add_system_log(f"🌐 IP assigned: {container_info['ip']}", 'deployment')
+    
+    if container_info['exposed_ports']:
+        add_system_log(f"🔌 Exposed ports: {', '.join(container_info['exposed_ports'])}", 'info')
+    
+    return container_info
+
+def claim_warm_container(spec, phases):
+    """Hand a pre-warmed container to a deploy, or None on a pool miss"""
+    pool = warm_pools.get((spec['image'], spec.get('profile', 'default'), shard_group(spec.get('tenant'))))
+    if pool is None or not pool.matches(spec) or not (local_host() and local_host().matches(spec)):
+        return None
+    container_info = timed_phase(phases, 'claim', pool.claim)
+    pool.refill_async()
+    if container_info is None:
+        return None
+    
+    # Labels are immutable in Docker; ownership moves to the registry instead
+    container = host_for(container_info).client.containers.prepare_model({'Id': container_info['id']})
+    try:
+        timed_phase(phases, 'rename', container.rename, spec['name'])
+        if container_info['status'] != 'running':
+            timed_phase(phases, 'start', docker_gate.call, container.start)
+    except Exception as e:
+        add_system_log(f"⚠️ Warm container claim failed, deploying fresh: {str(e)}", 'warning')
+        retire_pool_member(container_info)
+        return None
+    
+    claimed = time.time()
+    container_info.update(name=spec['name'], status='running', created=claimed,
+                          warm_pool=pool.name, tenant=spec['tenant'], **lifetime_fields(spec, claimed))
+    track_container(container_info)
+    add_system_log(f"♨️ Container {spec['name']} claimed from warm pool {pool.name}", 'deployment')
+    add_system_log(f"🌐 IP assigned: {container_info['ip']}", 'deployment')
+    return container_info
+
+def retire_pool_member(container_info):
+    """Remove a pool container and release its address"""
+    host = host_for(container_info)
+    try:
+        docker_gate.call(host.client.containers.prepare_model({'Id': container_info['id']}).remove, force=True)
+    except docker.errors.NotFound:
+        pass
+    except Exception as e:
+        add_system_log(f"⚠️ Could not remove pool container {container_info['name']}: {str(e)}", 'warning')
+    host.network_manager.release_ip(container_info['ip'])
+    release_placement(host)
+
+def validate_pool_config(config):
+    """Check a warm pool config from WARM_POOLS or POST /pools; raises ValueError"""
+    if not isinstance(config, dict):
+        raise ValueError("A pool config must be an object")
+    if not isinstance(config.get('image'), str) or not config['image'] or 'size' not in config:
+        raise ValueError("Missing 'image' or 'size' field")
+    size = config['size']
+    if isinstance(size, bool) or not isinstance(size, int) or not 0 <= size <= POOL_MAX_SIZE:
+        raise ValueError(f"'size' must be an integer from 0 to {POOL_MAX_SIZE}")
+    profile = config.get('profile', 'default')
+    if not isinstance(profile, str) or profile not in DEPLOY_PROFILES:
+        raise ValueError(f"Unknown profile '{profile}'")
+    if not isinstance(config.get('environment') or {}, dict):
+        raise ValueError("'environment' must be an object")
+    parse_tenant(config)
+
+def configure_warm_pool(config):
+    """Create or resize the pool for an image/profile/shard group and start filling it"""
+    tenant = config.get('tenant') or 'default'
+    key = (config['image'], config.get('profile', 'default'), shard_group(tenant))
+    with warm_pools_lock:
+        pool = warm_pools.get(key)
+        if pool is None:
+            pool = warm_pools[key] = WarmPool(
+                config['image'],
+                int(config['size']),
+                start=config.get('start', True),
+                profile=key[1],
+                environment=config.get('environment'),
+                command=config.get('command'),
+                tenant=tenant
+            )
+        else:
+            pool.size = int(config['size'])
+    # Reconfiguring is the way to retry a pool that was marked failing
+    pool.reset_failures()
+    for container_info in pool.trim():
+        pool_executor.submit(retire_pool_member, container_info)
+    pool.refill_async()
+    return pool
+
+def init_warm_pools(configs):
+    """Configure pools and reuse idle members left over from a previous run"""
+    valid = []
+    for config in configs:
         try:
-            time.sleep(60)  # Check every minute
-            for container_id in list(containers.keys()):
-                try:
-                    container = client.containers.get(container_id)
-                    if container.status == 'exited':
-                        container_name = containers[container_id]['name']
-                        add_system_log(f"🔄 Auto-cleanup: {container_name} (exited)", 'info')
-                        container.remove()
-                        container_info = containers.pop(container_id)
-                        network_manager.release_ip(container_info['ip'])
-                except docker.errors.NotFound:
-                    container_info = containers.pop(container_id, None)
-                    if container_info and network_manager:
-                        network_manager.release_ip(container_info['ip'])
+            validate_pool_config(config)
+            valid.append(config)
+        except ValueError as e:
+            add_system_log(f"⚠️ Skipping warm pool config: {str(e)}", 'warning')
+    configs = valid
+    pools = [configure_warm_pool({**config, 'size': 0}) for config in configs]
+    by_name = {pool.name: pool for pool in pools}
+    
+    host = local_host()
+    if not host.available:
+        # Targets apply right away; check_hosts finishes the setup when the host is back
+        for pool, config in zip(pools, configs):
+            pool.size = int(config['size'])
+        deferred_warm_pools[:] = configs
+        add_system_log("⚠️ Local Docker host unavailable, warm pools fill once it is back", 'warning')
+        return
+    for container_id, container in list_managed_containers(host).items():
+        pool_name = (container.attrs.get('Labels') or {}).get(POOL_LABEL)
+        if not pool_name or container_id in containers:
+            continue
+        container_info = container_info_from_summary(container.attrs, host)
+        host.network_manager.reserve_ip(container_info['ip'])
+        charge_placement(host)
+        pool = by_name.get(pool_name)
+        if pool and container_info['status'] in ('created', 'running'):
+            pool.add(container_info)
+        else:
+            pool_executor.submit(retire_pool_member, container_info)
+    
+    for pool, config in zip(pools, configs):
+        configure_warm_pool(config)
+        add_system_log(f"♨️ Warm pool {pool.name}: {len(pool.ready)} reused, target {pool.size}", 'info')
+
+def discard_pool_member(container_id, retire=False):
+    """Drop a pool container that died or was destroyed outside the manager"""
+    for pool in list(warm_pools.values()):
+        container_info = pool.discard(container_id)
+        if container_info is None:
+            continue
+        if retire:
+            pool_executor.submit(retire_pool_member, container_info)
+        else:
+            host = host_for(container_info)
+            host.network_manager.release_ip(container_info['ip'])
+            release_placement(host)
+        # Members that exit right after start would otherwise be replaced in a tight loop
+        delay = pool.record_death(container_info) if retire else 0
+        if pool.failing:
+            add_system_log(f"❌ Warm pool {pool.name} is failing: {pool.failures} members exited right after start",
+                           'error')
+        elif delay:
+            add_system_log(f"⚠️ Warm pool {pool.name} member exited early, refilling in {int(delay)}s", 'warning')
+            reaper.schedule(time.time() + delay, pool.refill_async)
+        else:
+            pool.refill_async()
+        return
+
+def snapshot_container(container_info, pause=True):
+    """Commit a container's filesystem to a local image and keep it as its reset point"""
+    host = host_for(container_info)
+    response = docker_gate.call(
+        host.client.api.commit,
+        container_info['id'],
+        repository=SNAPSHOT_REPOSITORY,
+        tag=container_info['name'],
+        message=f"Snapshot of {container_info['name']}",
+        pause=pause
+    )
+    snapshot = {
+        'id': response['Id'],
+        'image': f"{SNAPSHOT_REPOSITORY}:{container_info['name']}",
+        'created': time.time()
+    }
+    previous = container_info.get('snapshot')
+    set_container_fields(container_info['id'], snapshot=snapshot)
+    # The image the container was reset from stays until the container or its next reset drops it
+    if previous and previous['id'] not in (snapshot['id'], container_info.get('base_snapshot')):
+        remove_snapshot_image(host.name, previous['id'])
+    return snapshot
+
+def snapshot_images(container_info):
+    """Snapshot images a container holds: its reset point and the image it was reset from"""
+    images = {container_info.get('base_snapshot'), (container_info.get('snapshot') or {}).get('id')}
+    return images - {None}
+
+def remove_snapshot_image(host_name, image_id):
+    """Delete a superseded or orphaned snapshot image"""
+    host = hosts.get(host_name)
+    if host is None or not host.available:
+        return
+    try:
+        host.client.api.remove_image(image_id)
+    except docker.errors.NotFound:
+        pass
+    except docker.errors.APIError as e:
+        add_system_log(f"📦 Keeping snapshot image {image_id[7:19]}: {e.explanation or str(e)}", 'info')
+
+def reset_container(container_info, phases, from_snapshot=True):
+    """Recreate a container from its snapshot (or base image) with the same name, IP, labels and networks.
+    
+    The caller claims resetting[id] first; every path here releases it.
+    """
+    host = host_for(container_info)
+    old_id = container_info['id']
+    snapshot = container_info.get('snapshot') if from_snapshot else None
+    
+    try:
+        spec, extra_networks = prepare_reset(host, container_info, snapshot, phases)
+    except Exception as e:
+        end_reset(old_id)
+        # Gone from Docker already; ImageNotFound means the old container is still intact
+        if isinstance(e, docker.errors.NotFound) and not isinstance(e, docker.errors.ImageNotFound):
+            forget_container(old_id)
+        raise
+    
+    try:
+        timed_phase(phases, 'remove', docker_gate.call, host.client.api.remove_container, old_id, force=True)
+    except Exception as e:
+        end_reset(old_id)
+        if isinstance(e, docker.errors.NotFound):
+            forget_container(old_id)
+        raise
+    container = None
+    aliases = extra_networks.pop(container_info['network'], None)
+    # Shard IPs are leased and kept; private lab members get whatever their lab network hands out
+    pinned_ip = container_info['ip']
+    if pinned_ip and host.network_manager.shard_for_ip(pinned_ip) is None:
+        pinned_ip = None
+    try:
+        container = timed_phase(phases, 'create', docker_gate.call, create_lab_container, host, spec,
+                                container_info['network'], pinned_ip, aliases)
+        timed_phase(phases, 'connect', connect_networks, host, container.id, extra_networks)
+        timed_phase(phases, 'start', docker_gate.call, container.start)
+        if pinned_ip is None:
+            timed_phase(phases, 'reload', container.reload)
+    except Exception:
+        if container is not None:
+            remove_failed_container(container)
+        end_reset(old_id)
+        # The old container is gone, so its record, IP and quota go with it
+        forget_container(old_id)
+        raise
+    
+    # Hand the record, IP lease and lab membership over to the new container
+    now = time.time()
+    new_info = {**container_info, 'id': container.id, 'status': 'running', 'last_active': now, 'reset_at': now,
+                'base_snapshot': snapshot['id'] if snapshot else None}
+    if pinned_ip is None:
+        new_info['ip'] = container.attrs['NetworkSettings']['Networks'][container_info['network']]['IPAddress']
+        if new_info.get('access_url'):
+            new_info['access_url'] = f"http://{new_info['ip']}"
+    with containers_lock:
+        resetting.pop(old_id, None)
+        containers.pop(old_id, None)
+        containers[container.id] = new_info
+        if registry:
+            registry.delete_containers([old_id])
+            registry.save_container(new_info)
+    with idle_samples_lock:
+        idle_samples.pop(old_id, None)
+    lab = labs.get(new_info.get('lab'))
+    if lab is not None:
+        with labs_lock:
+            services = {**lab['services'], new_info['service']: container.id}
+        save_lab(lab, services=services)
+    schedule_reaping(new_info)
+    # The image the old container ran on is free now unless it is still needed
+    for image_id in snapshot_images(container_info) - snapshot_images(new_info):
+        reaper.schedule(time.time(), remove_snapshot_image, host.name, image_id)
+    event_hub.publish('container_removed', {'id': old_id, 'name': new_info['name']})
+    event_hub.publish('container_added', new_info)
+    return new_info
+
+def end_reset(container_id):
+    with containers_lock:
+        resetting.pop(container_id, None)
+
+def prepare_reset(host, container_info, snapshot, phases):
+    """Inspect the old container and check the image; returns (create spec, networks with aliases)"""
+    old_id = container_info['id']
+    # The image is already on the host, so this skips placement, pull and IP allocation
+    old = timed_phase(phases, 'inspect', host.client.api.inspect_container, old_id)
+    config = old['Config']
+    spec = {
+        'image': snapshot['id'] if snapshot else container_info['image'],
+        'name': container_info['name'],
+        'environment': config.get('Env'),
+        'command': config.get('Cmd'),
+        'volumes': old['HostConfig'].get('Binds'),
+        'profile': container_info['profile'],
+        'tenant': container_info.get('tenant'),
+        'labels': {k: v for k, v in (config.get('Labels') or {}).items() if k != POOL_LABEL}
+    }
+    # Every network (e.g. private lab networks) is rejoined under the same aliases
+    extra_networks = {
+        name: [alias for alias in endpoint.get('Aliases') or [] if alias != old_id[:12]]
+        for name, endpoint in old['NetworkSettings']['Networks'].items()
+    }
+    
+    # Make sure the image is there before the old container goes
+    if snapshot:
+        timed_phase(phases, 'image', host.client.api.inspect_image, snapshot['id'])
+    else:
+        timed_phase(phases, 'image', host.image_cache.ensure, spec['image'], 'if-not-present')
+    return spec, extra_networks
+
+def deploy_error_message(error, image):
+    """User-facing message for a failed deploy"""
+    if isinstance(error, docker.errors.ImageNotFound):
+        return f"Image '{image}' not found"
+    return str(error)
+
+def run_deploy_job(job, spec):
+    """Worker: pull, create and start a container for a deploy job"""
+    trace, token = start_trace('deploy', job=job['id'], container=spec['name'])
+    trace_buffer.add(trace)
+    update_job(job, status='running', started=time.time(), trace_id=trace.id)
+    
+    try:
+        add_system_log(f"🚀 Starting deployment: {spec['name']}", 'deployment')
+        container_info = claim_warm_container(spec, job['phases'])
+        if container_info is None:
+            host = timed_phase(job['phases'], 'place', place_container, spec)
+            pull_image(spec['image'], job['phases'], policy=spec['pull_policy'], host=host)
+            container_info = provision_container(spec, job['phases'], host)
+        update_job(job, status='succeeded', container=container_info, finished=time.time())
+    except Exception as e:
+        message = deploy_error_message(e, spec['image'])
+        add_system_log(f"❌ Deployment failed: {message}", 'error')
+        quota_tracker.release(spec['tenant'], 1, profile_memory(spec['profile']))
+        update_job(job, status='failed', error=message, finished=time.time())
+    finally:
+        finish_trace(trace, token)
+
+def run_batch_job(job, specs, parallelism, pull_policy):
+    """Worker: pull each distinct image once, then provision all seats concurrently"""
+    trace, token = start_trace('batch', job=job['id'], seats=len(specs))
+    trace_buffer.add(trace)
+    try:
+        run_batch_seats(job, specs, parallelism, pull_policy)
+    finally:
+        finish_trace(trace, token)
+
+def run_batch_seats(job, specs, parallelism, pull_policy):
+    """Body of run_batch_job, run inside the batch trace"""
+    update_job(job, status='running', started=time.time(), trace_id=current_trace.get().id)
+    add_system_log(f"🏫 Starting batch deployment of {len(specs)} containers", 'deployment')
+    placements, futures, settled = [], {}, set()
+    executor = None
+    
+    def settle(future):
+        """Record a finished seat; failed seats give back their quota"""
+        index = futures[future]
+        spec, seat = specs[index], job['seats'][index]
+        try:
+            container_info = future.result()
+            fields = {'status': 'succeeded', 'container': container_info}
         except Exception as e:
-            add_system_log(f"❌ Cleanup error: {str(e)}", 'error')
+            message = deploy_error_message(e, spec['image'])
+            add_system_log(f"❌ Deployment of {seat['name']} failed: {message}", 'error')
+            quota_tracker.release(spec['tenant'], 1, profile_memory(spec['profile']))
+            fields = {'status': 'failed', 'error': message}
+        with jobs_lock:
+            seat.update(fields)
+            seat['total'] = round(sum(seat['phases'].values()), 3)
+        settled.add(index)
+    
+    try:
+        # Place every seat first so the load of earlier seats counts for later ones
+        for spec in specs:
+            try:
+                placements.append(place_container(spec))
+            except Exception as e:
+                placements.append(e)
+        
+        # Pull each distinct image once per host it landed on
+        placed = [(host, spec['image']) for host, spec in zip(placements, specs) if isinstance(host, DockerHost)]
+        for host, image in dict.fromkeys(placed):
+            phase = image if len(hosts) == 1 else f"{image}@{host.name}"
+            pull_image(image, job['pulls'], phase=phase, policy=pull_policy, host=host)
+        
+        provision_started = time.time()
+        executor = ThreadPoolExecutor(max_workers=min(parallelism, len(specs)), thread_name_prefix='batch')
+        for index, (spec, host) in enumerate(zip(specs, placements)):
+            if isinstance(host, Exception):
+                future = Future()
+                future.set_exception(host)
+            else:
+                # Each seat thread carries the batch trace via a copy of this context
+                future = executor.submit(contextvars.copy_context().run, traced,
+                                         f"seat {spec['name']}", provision_container, spec,
+                                         job['seats'][index]['phases'], host)
+            futures[future] = index
+        
+        for future in as_completed(futures):
+            settle(future)
+        executor.shutdown()
+        
+        seat_times = [seat['total'] for seat in job['seats']]
+        succeeded = sum(1 for seat in job['seats'] if seat['status'] == 'succeeded')
+        summary = {
+            'requested': len(specs),
+            'succeeded': succeeded,
+            'failed': len(specs) - succeeded,
+            'pull_time': round(sum(job['pulls'].values()), 3),
+            'provision_time': round(time.time() - provision_started, 3),
+            'avg_seat_time': round(sum(seat_times) / len(seat_times), 3),
+            'max_seat_time': max(seat_times),
+            'total_time': round(time.time() - job['started'], 3)
+        }
+    except Exception as e:
+        add_system_log(f"❌ Batch deployment failed: {str(e)}", 'error')
+        if executor is not None:
+            # Queued seats never start; seats already provisioning finish and settle as usual
+            executor.shutdown(cancel_futures=True)
+            for future in futures:
+                if futures[future] not in settled and not future.cancelled():
+                    settle(future)
+        # Seats that never reached provisioning still hold their quota and placement
+        for index, spec in enumerate(specs):
+            if index in settled:
+                continue
+            quota_tracker.release(spec['tenant'], 1, profile_memory(spec['profile']))
+            if index < len(placements) and isinstance(placements[index], DockerHost):
+                release_placement(placements[index])
+            with jobs_lock:
+                job['seats'][index].update({'status': 'failed', 'error': f"Batch aborted: {str(e)}"})
+        update_job(job, status='failed', error=str(e), finished=time.time())
+        return
+    
+    add_system_log(f"🏫 Batch deployment finished: {succeeded}/{len(specs)} containers "
+                   f"in {summary['total_time']}s", 'deployment')
+    update_job(
+        job,
+        status='succeeded' if succeeded == len(specs) else 'failed',
+        summary=summary,
+        error=None if succeeded == len(specs) else f"{len(specs) - succeeded} seats failed",
+        finished=time.time()
+    )
 
-if __name__ == '__main__':
-    # Initialize network manager
-    network_manager = NetworkManager()
+def register_template(name, template, persist=True):
+    """Validate and store a lab template; raises ValueError"""
+    template = validate_template(name, template)
+    with labs_lock:
+        lab_templates[name] = template
+    if persist and registry:
+        registry.save_template(template)
+    return template
+
+def init_lab_templates():
+    """Load built-in and LAB_TEMPLATES templates, then those registered over the API"""
+    stored = {template['name']: template for template in registry.load_templates()}
+    for name, template in {**DEFAULT_TEMPLATES, **LAB_TEMPLATES, **stored}.items():
+        try:
+            register_template(name, template, persist=False)
+        except ValueError as e:
+            add_system_log(f"⚠️ Skipping lab template {name}: {str(e)}", 'warning')
+    add_system_log(f"🧩 {len(lab_templates)} lab templates available", 'info')
+
+def save_lab(lab, **fields):
+    """Update a lab record under the labs lock and persist it"""
+    with labs_lock:
+        lab.update(fields)
+        if registry:
+            registry.save_lab(lab)
+
+def lab_snapshot(lab):
+    """A lab record with its members' container_info, keyed by service"""
+    with labs_lock:
+        lab = {**lab, 'services': dict(lab['services']), 'networks': dict(lab['networks']),
+               'subnets': dict(lab.get('subnets', {}))}
+    with containers_lock:
+        lab['containers'] = {service: containers.get(cid) for service, cid in lab['services'].items()}
+    return lab
+
+def create_lab_networks(lab, template, host):
+    """Create the lab's private bridge networks on its host"""
+    for network, config in template['networks'].items():
+        name = f"lab-{lab['id']}-{network}"
+        subnet = host.network_manager.allocate_lab_subnet()
+        try:
+            host.client.networks.create(
+                name,
+                driver="bridge",
+                internal=config['internal'],
+                ipam=docker.types.IPAMConfig(
+                    pool_configs=[docker.types.IPAMPool(subnet=str(subnet), gateway=str(subnet.network_address + 1))]
+                ),
+                labels={MANAGER_LABEL: MANAGER_ID, LAB_LABEL: lab['id']}
+            )
+        except Exception:
+            host.network_manager.release_lab_subnet(subnet)
+            raise
+        with labs_lock:
+            lab['networks'][network] = name
+            lab.setdefault('subnets', {})[name] = str(subnet)
+
+def remove_lab_networks(lab, host):
+    """Remove a lab's networks and hand their subnets back to the pool"""
+    for name in list(lab['networks'].values()):
+        try:
+            host.client.api.remove_network(name)
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            # The subnet stays taken while the network exists; a restart rediscovers it
+            add_system_log(f"⚠️ Could not remove lab network {name}: {str(e)}", 'warning')
+            continue
+        if lab.get('subnets', {}).get(name) and host.network_manager:
+            host.network_manager.release_lab_subnet(lab['subnets'][name])
+
+def connect_networks(host, container_id, networks):
+    """Attach a container to extra networks, given as {network name: aliases}"""
+    for name, aliases in networks.items():
+        host.client.api.connect_container_to_network(container_id, name, aliases=aliases or None)
+
+def connect_lab_networks(host, container_id, lab, spec):
+    """Attach a lab member to its private networks; the service name resolves over Docker DNS"""
+    # Private services are created on their first lab network already
+    networks = spec['networks'] if spec['expose'] else spec['networks'][1:]
+    connect_networks(host, container_id, {lab['networks'][network]: [spec['service']] for network in networks})
+
+def provision_lab_service(lab, spec, phases, host):
+    """Create one lab member, join it to the lab networks, then start it.
     
-    # Add startup logs
-    add_system_log("🐳 Docker Lab Manager starting up", 'info')
-    add_system_log("🔧 Network manager initialized", 'info')
-    add_system_log("🚀 Ready to deploy containers", 'info')
+    Only exposed services get a shard IP; the rest live on the lab networks alone,
+    so an internal network really is cut off from everything outside the lab.
+    """
+    if spec['expose']:
+        container_info = launch_container(spec, phases, start=False, host=host)
+        network_name = container_info['network']
+        container = host.client.containers.prepare_model({'Id': container_info['id']})
+    else:
+        network_name = lab['networks'][spec['networks'][0]]
+        try:
+            container = timed_phase(phases, 'create', docker_gate.call, create_lab_container,
+                                    host, spec, network_name, None, [spec['service']])
+        except Exception:
+            release_placement(host)
+            raise
+    try:
+        timed_phase(phases, 'connect', connect_lab_networks, host, container.id, lab, spec)
+        timed_phase(phases, 'start', docker_gate.call, container.start)
+        timed_phase(phases, 'reload', container.reload)
+    except Exception:
+        remove_failed_container(container)
+        if spec['expose']:
+            host.network_manager.release_ip(container_info['ip'])
+        release_placement(host)
+        raise
+    if not spec['expose']:
+        container_ip = container.attrs['NetworkSettings']['Networks'][network_name]['IPAddress']
+        container_info = new_container_info(container, spec, host, network_name, container_ip)
+    container_info['status'] = container.status
+    track_container(container_info)
+    add_system_log(f"✅ Lab service {spec['service']} up as {spec['name']} ({container_info['ip']})", 'deployment')
+    return container_info
+
+def remove_lab_member(host, container_id):
+    try:
+        docker_gate.call(host.client.containers.prepare_model({'Id': container_id}).remove, force=True)
+    except docker.errors.NotFound:
+        pass
+
+def teardown_lab(lab):
+    """Remove a lab's containers in parallel, then its networks and record; returns errors by service"""
+    save_lab(lab, status='removing')
+    host = hosts.get(lab['host'])
+    members = dict(lab['services'])
+    errors = {}
+    if members:
+        with ThreadPoolExecutor(max_workers=min(len(members), CLEANUP_WORKERS), thread_name_prefix='lab') as executor:
+            futures = {executor.submit(remove_lab_member, host, cid): service for service, cid in members.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[futures[future]] = str(e)
+    forget_containers([cid for service, cid in members.items() if service not in errors])
+    if errors:
+        # Keep the record so the teardown can be retried
+        save_lab(lab, status='failed', services={service: members[service] for service in errors})
+        add_system_log(f"❌ Lab {lab['name']} teardown left {len(errors)} containers", 'error')
+        return errors
+    
+    remove_lab_networks(lab, host)
+    with labs_lock:
+        labs.pop(lab['id'], None)
+        if registry:
+            registry.delete_lab(lab['id'])
+    add_system_log(f"🧹 Lab {lab['name']} removed", 'info')
+    return errors
+
+def collect_lab(lab_id):
+    """Reaper task: tear down what is left of a lab once all its containers are gone"""
+    with labs_lock:
+        lab = labs.get(lab_id)
+        if lab is None or lab['status'] in ('deploying', 'removing'):
+            return
+    with containers_lock:
+        if any(info.get('lab') == lab_id for info in containers.values()):
+            return
+    host = hosts.get(lab['host'])
+    if host is None or not host.available:
+        return
+    save_lab(lab, services={})
+    teardown_lab(lab)
+
+def schedule_lab_reaping(lab):
+    """Put a ready lab's expiry and first idle check on the reaper heap"""
+    if lab.get('expires_at'):
+        reaper.schedule(lab['expires_at'], expire_lab, lab['id'], lab['expires_at'])
+    if lab.get('idle_timeout'):
+        with idle_samples_lock:
+            # One idle-check chain per lab, sampling all of its members
+            if lab['id'] in idle_samples:
+                return
+            idle_samples[lab['id']] = None
+        reaper.schedule(time.time() + min(IDLE_CHECK_INTERVAL, lab['idle_timeout']), check_idle_lab, lab['id'])
+
+def reap_lab(lab, reason):
+    add_system_log(f"⏰ Reaping lab {lab['name']} ({reason})", 'warning')
+    teardown_lab(lab)
+
+def expire_lab(lab_id, expires_at):
+    """Reaper task: tear down a lab whose TTL has run out"""
+    lab = labs.get(lab_id)
+    # Stale heap entries (removed or extended labs) are skipped here
+    if lab is None or lab['status'] != 'ready' or lab.get('expires_at') != expires_at:
+        return
+    host = hosts.get(lab['host'])
+    if host is None or not host.available:
+        reaper.schedule(time.time() + HOST_CHECK_INTERVAL, expire_lab, lab_id, expires_at)
+        return
+    reap_lab(lab, 'TTL expired')
+
+def check_idle_lab(lab_id):
+    """Reaper task: a lab is idle only while every member is; reap it once idle too long"""
+    with labs_lock:
+        lab = labs.get(lab_id)
+        members = list(lab['services'].values()) if lab else []
+    if lab is None or lab['status'] != 'ready' or not lab.get('idle_timeout'):
+        with idle_samples_lock:
+            idle_samples.pop(lab_id, None)
+        return
+    
+    now = time.time()
+    try:
+        sample = {container_id: sample_activity(container_id) for container_id in members}
+    except docker.errors.NotFound:
+        # A member went away; collect_lab handles the rest and the next check starts afresh
+        sample = None
+    except Exception as e:
+        add_system_log(f"⚠️ Idle check of lab {lab['name']} failed: {str(e)}", 'warning')
+        reaper.schedule(now + IDLE_CHECK_INTERVAL, check_idle_lab, lab_id)
+        return
+    with idle_samples_lock:
+        previous = idle_samples.get(lab_id)
+        idle_samples[lab_id] = sample
+    
+    if previous is None or sample is None:
+        reaper.schedule(now + IDLE_CHECK_INTERVAL, check_idle_lab, lab_id)
+        return
+    for container_id, (cpu, net) in sample.items():
+        # New (reset) members and restarted counters count as activity
+        if container_id not in previous:
+            active = True
+        else:
+            cpu_delta, net_delta = cpu - previous[container_id][0], net - previous[container_id][1]
+            active = cpu_delta < 0 or net_delta < 0 or cpu_delta >= IDLE_CPU_SECONDS or net_delta >= IDLE_NET_BYTES
+        if active:
+            save_lab(lab, last_active=now)
+            break
+    
+    idle_for = now - lab['last_active']
+    if idle_for >= lab['idle_timeout']:
+        reap_lab(lab, f"idle for {int(idle_for)}s")
+        return
+    remaining = lab['idle_timeout'] - idle_for
+    reaper.schedule(now + min(IDLE_CHECK_INTERVAL, remaining), check_idle_lab, lab_id)
+
+def run_lab_job(job, lab, template, specs, pull_policy):
+    """Worker: deploy every service of a lab template, rolling the lab back if any fails"""
+    trace, token = start_trace('lab', job=job['id'], lab=lab['id'], template=template['name'])
+    trace_buffer.add(trace)
+    try:
+        run_lab_services(job, lab, template, specs, pull_policy)
+    finally:
+        finish_trace(trace, token)
+
+def run_lab_services(job, lab, template, specs, pull_policy):
+    """Body of run_lab_job, run inside the lab trace"""
+    update_job(job, status='running', started=time.time(), trace_id=current_trace.get().id)
+    add_system_log(f"🧩 Starting lab {lab['name']} from template {template['name']}", 'deployment')
+    host, attempted = None, 0
+    executor = ThreadPoolExecutor(max_workers=min(max(map(len, template['levels'])), BATCH_PARALLELISM),
+                                  thread_name_prefix='lab')
+    try:
+        # Private lab networks are per daemon, so the whole lab lands on one host
+        host = timed_phase(job['phases'], 'place', place_container, lab['placement'], len(specs))
+        save_lab(lab, host=host.name)
+        for image in dict.fromkeys(spec['image'] for spec in specs.values()):
+            pull_image(image, job['pulls'], phase=image, policy=pull_policy, host=host)
+        timed_phase(job['phases'], 'networks', create_lab_networks, lab, template, host)
+        
+        # Services in a level start together once every level before them is up
+        for level in template['levels']:
+            futures = {
+                executor.submit(contextvars.copy_context().run, traced, f"service {service}",
+                                provision_lab_service, lab, specs[service], job['services'][service]['phases'], host): service
+                for service in level
+            }
+            attempted += len(level)
+            failed = []
+            for future in as_completed(futures):
+                service = futures[future]
+                try:
+                    container_info = future.result()
+                    fields = {'status': 'succeeded', 'container': container_info}
+                    with labs_lock:
+                        lab['services'][service] = container_info['id']
+                except Exception as e:
+                    fields = {'status': 'failed', 'error': deploy_error_message(e, specs[service]['image'])}
+                    failed.append(f"{service}: {fields['error']}")
+                with jobs_lock:
+                    job['services'][service].update(fields)
+            if failed:
+                raise Exception(f"Lab services failed ({'; '.join(sorted(failed))})")
+    except Exception as e:
+        add_system_log(f"❌ Lab {lab['name']} failed, rolling back: {str(e)}", 'error')
+        # Tracked members release their quota on removal; the rest are released here
+        unprovisioned = [spec for service, spec in specs.items() if service not in lab['services']]
+        quota_tracker.release(lab['tenant'], len(unprovisioned),
+                              sum(profile_memory(spec['profile']) for spec in unprovisioned))
+        if host is not None:
+            release_placement(host, len(specs) - attempted)
+            teardown_lab(lab)
+        else:
+            with labs_lock:
+                labs.pop(lab['id'], None)
+                if registry:
+                    registry.delete_lab(lab['id'])
+        update_job(job, status='failed', error=str(e), finished=time.time())
+        return
+    finally:
+        executor.shutdown()
+    
+    save_lab(lab, status='ready', **lifetime_fields(lab, time.time()))
+    schedule_lab_reaping(lab)
+    total = round(time.time() - job['started'], 3)
+    add_system_log(f"🧩 Lab {lab['name']} ready: {len(specs)} services in {total}s", 'deployment')
+    update_job(job, status='succeeded', summary={'services': len(specs), 'total_time': total},
+               finished=time.time())
+
+def track_container(container_info):
+    """Start tracking a container and persist its record"""
+    with containers_lock:
+        containers[container_info['id']] = container_info
+        if registry:
+            registry.save_container(container_info)
+    schedule_reaping(container_info)
+    event_hub.publish('container_added', container_info)
+
+def set_container_fields(container_id, **fields):
+    """Update a tracked container's fields and persist them"""
+    with containers_lock:
+        container_info = containers.get(container_id)
+        if container_info is None:
+            return
+        if all(container_info.get(k) == v for k, v in fields.items()):
+            return
+        container_info.update(fields)
+        if registry:
+            registry.save_container(container_info)
+    event_hub.publish('container_updated', container_info)
+
+def forget_containers(container_ids):
+    """Drop containers from tracking and release their IPs in one batch"""
+    with containers_lock:
+        # A reset removes the old container on purpose; its record moves to the new one
+        forgotten = [containers.pop(cid) for cid in container_ids if cid in containers and cid not in resetting]
+        if forgotten and registry:
+            registry.delete_containers([info['id'] for info in forgotten])
+    by_host = {}
+    for container_info in forgotten:
+        by_host.setdefault(host_for(container_info), []).append(container_info)
+    for host, infos in by_host.items():
+        if host is None:
+            continue
+        if host.network_manager:
+            host.network_manager.release_ips([info['ip'] for info in infos])
+        release_placement(host, len(infos))
+    with idle_samples_lock:
+        for container_info in forgotten:
+            idle_samples.pop(container_info['id'], None)
+    for container_info in forgotten:
+        if container_info.get('tenant'):
+            quota_tracker.release(container_info['tenant'], 1, container_info.get('mem_limit', 0))
+        event_hub.publish('container_removed', {'id': container_info['id'], 'name': container_info['name']})
+    # A lab whose last member went away (expiry, cleanup, manual delete) drops its networks too
+    for lab_id in {info['lab'] for info in forgotten if info.get('lab')}:
+        reaper.schedule(time.time(), collect_lab, lab_id)
+    for container_info in forgotten:
+        for image_id in snapshot_images(container_info):
+            reaper.schedule(time.time(), remove_snapshot_image, container_info.get('host', LAB_HOST_NAME), image_id)
+    return forgotten
+
+def forget_container(container_id):
+    """Drop a container from tracking and release its IP"""
+    forgotten = forget_containers([container_id])
+    return forgotten[0] if forgotten else None
+
+def container_info_from_summary(attrs, host):
+    """Build container_info from a sparse containers.list() entry on host"""
+    labels = attrs.get('Labels') or {}
+    networks = (attrs.get('NetworkSettings') or {}).get('Networks') or {}
+    network_name = labels.get(NETWORK_LABEL, LEGACY_NETWORK)
+    container_ip = labels.get(IP_LABEL) or networks.get(network_name, {}).get('IPAddress')
+    profile = labels.get(PROFILE_LABEL, 'default')
+    exposed_ports = sorted({f"{p['PrivatePort']}/{p['Type']}" for p in attrs.get('Ports') or []})
+    return {
+        'id': attrs['Id'],
+        'name': (attrs.get('Names') or ['/' + attrs['Id'][:12]])[0].lstrip('/'),
+        'image': attrs.get('Image'),
+        'ip': container_ip,
+        'network': network_name,
+        'host': host.name,
+        'status': attrs.get('State'),
+        'exposed_ports': exposed_ports,
+        'created': attrs.get('Created', time.time()),
+        'access_url': f"http://{container_ip}" if '80/tcp' in exposed_ports else None,
+        # Containers labelled before tenants existed belong to the default tenant
+        'tenant': labels.get(TENANT_LABEL) or 'default',
+        'profile': profile,
+        'mem_limit': profile_memory(profile) if profile in DEPLOY_PROFILES else 0,
+        **({'lab': labels[LAB_LABEL], 'service': labels.get(SERVICE_LABEL)} if LAB_LABEL in labels else {}),
+        # Adopted containers predate their record, so no lifetime limit is imposed on them
+        **lifetime_fields({'ttl': 0, 'idle_timeout': 0}, time.time())
+    }
+
+def list_managed_containers(host):
+    """All containers owned by this manager on host, keyed by id, in one API call"""
+    # sparse=True skips docker-py's per-container inspect
+    return {
+        c.id: c for c in host.client.containers.list(
+            all=True, sparse=True, filters={'label': f'{MANAGER_LABEL}={MANAGER_ID}'}
+        )
+    }
+
+def reconcile_containers(host):
+    """Resync a host's tracked containers with one label-filtered list call"""
+    live = list_managed_containers(host)
+    adopted, changed = [], []
+    with containers_lock:
+        tracked = [cid for cid, info in containers.items() if info.get('host', LAB_HOST_NAME) == host.name]
+        for container_id, container in live.items():
+            container_info = containers.get(container_id)
+            if container_info is None:
+                # Idle warm pool members are owned by their pool
+                if POOL_LABEL in (container.attrs.get('Labels') or {}):
+                    continue
+                # A reset's replacement is tracked once the reset finishes
+                if (container.attrs.get('Names') or [''])[0].lstrip('/') in resetting.values():
+                    continue
+                # Labelled by us but unknown, e.g. the registry was lost
+                container_info = container_info_from_summary(container.attrs, host)
+                containers[container_id] = container_info
+                adopted.append(container_info)
+            elif container_info['status'] == container.status:
+                continue
+            else:
+                container_info['status'] = container.status
+                changed.append(container_info)
+            if registry:
+                registry.save_container(container_info)
+    
+    for container_info in adopted:
+        quota_tracker.charge(container_info['tenant'], 1, container_info['mem_limit'])
+        schedule_reaping(container_info)
+        event_hub.publish('container_added', container_info)
+    for container_info in changed:
+        event_hub.publish('container_updated', container_info)
+    
+    charge_placement(host, len(adopted))
+    for container_info in adopted:
+        if container_info['ip']:
+            host.network_manager.reserve_ip(container_info['ip'])
+    
+    removed = [cid for cid in tracked if cid not in live]
+    forget_containers(removed)
+    
+    if adopted:
+        add_system_log(f"🔄 Reconcile adopted {len(adopted)} labelled containers on {host.name}", 'info')
+    if removed:
+        add_system_log(f"🔄 Reconcile dropped {len(removed)} missing containers on {host.name}", 'warning')
+    return live
+
+def restore_state():
+    """Reload container records, IP leases, labs and job history from the registry"""
+    started = time.time()
+    records = registry.load_containers()
+    # Containers on hosts no longer configured cannot be reached or reconciled
+    dropped = [info['id'] for info in records if info.get('host', LAB_HOST_NAME) not in hosts]
+    if dropped:
+        registry.delete_containers(dropped)
+        records = [info for info in records if info['id'] not in dropped]
+        add_system_log(f"⚠️ Dropped {len(dropped)} containers on hosts that are no longer configured", 'warning')
+    with containers_lock:
+        for container_info in records:
+            containers[container_info['id']] = container_info
+            # Records from before quotas existed (or adopted without a label) count against the default tenant
+            container_info['tenant'] = container_info.get('tenant') or 'default'
+            quota_tracker.charge(container_info['tenant'], 1, container_info.get('mem_limit', 0))
+            # Records from before lifetimes existed keep living without limits
+            for key, value in lifetime_fields({'ttl': 0, 'idle_timeout': 0}, time.time()).items():
+                container_info.setdefault(key, value)
+            # Time the manager was down is not idle time; activity is measured afresh
+            container_info['last_active'] = time.time()
+            # Records from before sharding live on the legacy network, on the local host
+            container_info.setdefault('network', LEGACY_NETWORK)
+            container_info.setdefault('host', LAB_HOST_NAME)
+    for container_info in records:
+        host = host_for(container_info)
+        charge_placement(host)
+        # A host that is down now seeds its leases from network endpoints once it is back
+        if host.network_manager and container_info.get('ip'):
+            host.network_manager.reserve_ip(container_info['ip'])
+    
+    history = registry.load_jobs(MAX_JOB_HISTORY)
+    with jobs_lock:
+        for job in history:
+            if not job['finished']:
+                job.update(status='failed', error='Interrupted by manager restart', finished=time.time())
+                registry.save_job(job)
+            jobs[job['id']] = job
+    
+    for container_info in records:
+        schedule_reaping(container_info)
+    
+    for lab in registry.load_labs():
+        # Labs never placed own nothing; labs on removed hosts cannot be reached
+        if lab['host'] not in hosts:
+            registry.delete_lab(lab['id'])
+            continue
+        # A lab caught mid-deploy or mid-teardown is left for the user to remove
+        if lab['status'] in ('deploying', 'removing'):
+            lab['status'] = 'failed'
+            registry.save_lab(lab)
+        labs[lab['id']] = lab
+        reaper.schedule(time.time() + RECONCILE_INTERVAL, collect_lab, lab['id'])
+        if lab['status'] == 'ready':
+            # Idle time is counted from the restart, as for containers
+            lab['last_active'] = time.time()
+            schedule_lab_reaping(lab)
     
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_orphaned_containers, daemon=True)
-    cleanup_thread.start()
+    add_system_log(f"💾 Restored {len(records)} containers, {len(labs)} labs and {len(history)} jobs "
+                   f"in {time.time() - started:.2f}s", 'info')
+
+def handle_docker_event(host, event):
+    """Apply a single Docker event from host to the container cache"""
+    event_type = event.get('Type')
+    action = event.get('Action', '')
+    actor = event.get('Actor', {})
+    
+    if event_type == 'container':
+        container_id = actor.get('ID')
+        if container_id not in containers:
+            if action in ('die', 'destroy'):
+                discard_pool_member(container_id, retire=(action == 'die'))
+            return
+        if action == 'destroy':
+            container_info = forget_container(container_id)
+            if container_info:
+                add_system_log(f"🗑️ Container {container_info['name']} destroyed", 'warning')
+        elif action in CONTAINER_EVENT_STATUS:
+            set_container_fields(container_id, status=CONTAINER_EVENT_STATUS[action])
     
-    # Start Flask app on port 62111
-    app.run(host='0.0.0.0', port=62111, debug=False)
\ No newline at end of file
+    elif event_type == 'image' and action in ('delete', 'untag'):
+        host.image_cache.invalidate(actor.get('ID'))
+    
+    elif event_type == 'network' and action == 'connect':
+        attributes = actor.get('Attributes', {})
+        container_id = attributes.get('container')
+        if container_id not in containers:
+            return
+        network_name = containers[container_id].get('network')
+        if attributes.get('name') != network_name:
+            return
+        try:
+            container = host.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            return
+        networks = container.attrs['NetworkSettings']['Networks']
+        container_ip = networks.get(network_name, {}).get('IPAddress')
+        if container_ip:
+            set_container_fields(container_id, ip=container_ip)
+
+def watch_docker_events(host):
+    """Background task keeping one host's containers in sync with its Docker events"""
+    state = host.event_stream
+    while True:
+        # Wait for the health check to bring the host (and its network shards) up
+        if not host.available:
+            time.sleep(EVENT_RECONNECT_DELAY)
+            continue
+        try:
+            # Subscribe before reconciling so nothing slips between the two
+            events = host.client.events(decode=True, filters={'type': ['container', 'network', 'image']})
+            reconcile_containers(host)
+            state['connected'] = True
+            for event in events:
+                state['last_event'] = event.get('time')
+                handle_docker_event(host, event)
+                if event.get('timeNano'):
+                    EVENT_LAG_SECONDS.observe(max(time.time() - event['timeNano'] / 1e9, 0))
+        except Exception as e:
+            add_system_log(f"❌ Event stream error on {host.name}: {str(e)}", 'error')
+        state['connected'] = False
+        state['reconnects'] += 1
+        time.sleep(EVENT_RECONNECT_DELAY)
+
+# Application factory state
+app_started = False
+app_start_lock = threading.Lock()
+
+def create_app():
+    """Application factory: initialise manager state and background threads once per process"""
+    global registry, app_started
+    with app_start_lock:
+        if app_started:
+            return app
+        
+        # Add startup logs
+        add_system_log("🐳 Docker Lab Manager starting up", 'info')
+        
+        # Connect to every Docker host; each gets its own network shards
+        init_docker_hosts()
+        
+        # Reload state from the on-disk registry; the event watcher reconciles it
+        registry = Registry(REGISTRY_PATH)
+        restore_state()
+        init_lab_templates()
+        init_warm_pools(WARM_POOLS)
+        add_system_log("🚀 Ready to deploy containers", 'info')
+        
+        # Reconcile, TTL and idle reaping all run off one deadline heap
+        reaper.schedule(time.time() + RECONCILE_INTERVAL, cleanup_orphaned_containers)
+        reaper.schedule(time.time() + HOST_CHECK_INTERVAL, check_hosts)
+        reaper_thread = threading.Thread(target=reaper.run, daemon=True)
+        reaper_thread.start()
+        
+        # Start container stats sampler
+        stats_thread = threading.Thread(target=stats_sampler.run, daemon=True)
+        stats_thread.start()
+        
+        # Start one Docker event watcher per host
+        for host in hosts.values():
+            events_thread = threading.Thread(target=watch_docker_events, args=(host,), daemon=True,
+                                             name=f"events-{host.name}")
+            events_thread.start()
+        
+        app_started = True
+    return app
+
+if __name__ == '__main__':
+    # Development server on LAB_PORT; production runs gunicorn with gunicorn.conf.py
+    create_app().run(host='0.0.0.0', port=LAB_PORT, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings for running the Docker Lab Manager in production
+"""
+
+import os
+
+# Same LAB_PORT (and default) the dev server and dashboard use in app.py
+bind = f"0.0.0.0:{int(os.environ.get('LAB_PORT', 62111))}"
+
+# Threaded workers keep long-lived SSE and log streams from starving the API
+worker_class = 'gthread'
+
+# The container cache, IP allocator and warm pools live in the worker process,
+# so scale with threads; more than one worker would allocate IPs independently
+workers = int(os.environ.get('LAB_WORKERS', 1))
+threads = int(os.environ.get('LAB_THREADS', 64))
+
+timeout = int(os.environ.get('LAB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('LAB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('LAB_KEEPALIVE', 5))
+
+# Each worker builds its own state through create_app() after the fork
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+if workers > 1:
+    raise RuntimeError(f"LAB_WORKERS={workers}: manager state is per process, so IP allocations "
+                       f"would collide; scale with LAB_THREADS instead")
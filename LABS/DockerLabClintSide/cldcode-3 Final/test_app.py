@@ -0,0 +1,162 @@
+"""
+Unit tests for the Docker Lab Manager; they run without a Docker daemon
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import docker
+
+# app.py connects at import time; the tests only need the classes
+with mock.patch.object(docker, 'from_env'):
+    import app
+
+
+def shard_network(name, subnet, group, endpoints):
+    """A fake docker network as networks.list() returns it"""
+    network = mock.MagicMock()
+    network.name = name
+    network.attrs = {
+        'IPAM': {'Config': [{'Subnet': subnet}]},
+        'Labels': {app.MANAGER_LABEL: app.MANAGER_ID, app.SHARD_LABEL: group},
+        'Containers': {f"c{i}": {'IPv4Address': f"{ip}/24"} for i, ip in enumerate(endpoints)}
+    }
+    return network
+
+
+class ShardGroupTests(unittest.TestCase):
+    
+    def test_update_rebuckets_after_allocation(self):
+        group = app.ShardGroup(253)
+        a = app.NetworkShard('a', '10.200.0.0/24', 'g', 0)
+        b = app.NetworkShard('b', '10.200.1.0/24', 'g', 1)
+        group.add(a)
+        group.add(b)
+        for _ in range(10):
+            old_free = a.free
+            a.allocator.allocate()
+            group.update(a, old_free)
+        self.assertIs(group.least_loaded(), b)
+        
+        old_free = a.free
+        a.allocator.release_many([f"10.200.0.{i}" for i in range(2, 12)])
+        group.update(a, old_free)
+        self.assertEqual(group._top, 253)
+    
+    def test_full_shard_is_not_least_loaded(self):
+        group = app.ShardGroup(253)
+        shard = app.NetworkShard('a', '10.200.0.0/24', 'g', 0)
+        group.add(shard)
+        for _ in range(253):
+            old_free = shard.free
+            shard.allocator.allocate()
+            group.update(shard, old_free)
+        self.assertIsNone(group.least_loaded())
+
+
+class NetworkManagerSeedTests(unittest.TestCase):
+    
+    def manager(self, networks):
+        client = mock.MagicMock()
+        client.networks.list.return_value = networks
+        client.networks.get.side_effect = docker.errors.NotFound('missing')
+        with mock.patch.object(app, 'add_system_log'):
+            return app.NetworkManager(client)
+    
+    def test_restored_shard_is_bucketed_by_its_seeded_endpoints(self):
+        endpoints = [f"10.200.0.{i}" for i in range(2, 252)]
+        manager = self.manager([shard_network('lab-net-0', '10.200.0.0/24', 'g', endpoints)])
+        shard = manager.shards['lab-net-0']
+        self.assertEqual(shard.free, 3)
+        self.assertEqual(manager._groups['g']._top, 3)
+    
+    def test_full_restored_shard_grows_a_new_one(self):
+        endpoints = [f"10.200.0.{i}" for i in range(2, 252)]
+        manager = self.manager([shard_network('lab-net-0', '10.200.0.0/24', 'g', endpoints)])
+        for _ in range(3):
+            shard, _ = manager.allocate('g')
+            self.assertEqual(shard.name, 'lab-net-0')
+        with mock.patch.object(app, 'add_system_log'):
+            shard, ip = manager.allocate('g')
+        self.assertNotEqual(shard.name, 'lab-net-0')
+        self.assertTrue(ip.startswith('10.200.1.'))
+
+
+
+class LabSubnetTests(unittest.TestCase):
+    
+    def manager(self, networks=()):
+        client = mock.MagicMock()
+        client.networks.list.return_value = list(networks)
+        client.networks.get.side_effect = docker.errors.NotFound('missing')
+        with mock.patch.object(app, 'add_system_log'):
+            return app.NetworkManager(client)
+    
+    def test_subnets_come_from_the_private_pool_and_are_reused(self):
+        manager = self.manager()
+        first, second = manager.allocate_lab_subnet(), manager.allocate_lab_subnet()
+        self.assertTrue(first.subnet_of(manager.lab_supernet))
+        self.assertEqual(first.prefixlen, app.LAB_PRIVATE_PREFIX)
+        self.assertFalse(first.overlaps(second))
+        manager.release_lab_subnet(str(first))
+        manager.release_lab_subnet(str(first))
+        self.assertEqual(manager.allocate_lab_subnet(), first)
+        self.assertNotEqual(manager.allocate_lab_subnet(), first)
+    
+    def test_existing_lab_networks_keep_their_subnets(self):
+        manager = self.manager()
+        taken = manager.allocate_lab_subnet()
+        network = mock.MagicMock()
+        network.name = 'lab-abc-backend'
+        network.attrs = {'IPAM': {'Config': [{'Subnet': str(taken)}]}, 'Labels': {app.LAB_LABEL: 'abc'}}
+        manager_subnet = self.manager([network]).allocate_lab_subnet()
+        self.assertNotEqual(manager_subnet, taken)
+
+
+
+class LogFollowerTests(unittest.TestCase):
+    
+    def test_first_subscriber_of_a_cold_follower_gets_only_its_tail(self):
+        history = b''.join(f"2026-01-01T00:00:{i:02d}.000000000Z line {i}\n".encode() for i in range(10))
+        live = threading.Event()
+        
+        def follow():
+            live.wait(5)
+            yield b"2026-01-01T00:01:00.000000000Z live\n"
+            threading.Event().wait(5)
+        
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = follow()
+        container = mock.MagicMock()
+        container.logs.side_effect = lambda **kwargs: stream if kwargs.get('stream') else history
+        client = mock.MagicMock()
+        client.containers.prepare_model.return_value = container
+        with mock.patch.object(app, 'container_client', return_value=client):
+            entries = app.follow_log_entries('cold', None, 3)
+            lines = [next(entries)['line'] for _ in range(3)]
+            live.set()
+            lines.append(next(entry for entry in entries if entry)['line'])
+            entries.close()
+        self.assertEqual(lines, ['line 7', 'line 8', 'line 9', 'live'])
+
+
+class QuotaTrackerTests(unittest.TestCase):
+    
+    def test_no_quotas_means_unlimited_per_tenant_usage(self):
+        tracker = app.QuotaTracker({})
+        self.assertIsNone(tracker.reserve('alice', 500, 2 ** 40))
+        self.assertIsNone(tracker.reserve('bob', 500, 2 ** 40))
+        self.assertEqual(set(tracker.snapshot()['tenants']), {'alice', 'bob'})
+    
+    def test_tenants_without_a_quota_share_the_default_bucket(self):
+        tracker = app.QuotaTracker({'default': {'max_containers': 3}, 'cs101': {'max_containers': 10}})
+        self.assertIsNone(tracker.reserve('alice', 2, 0))
+        self.assertIsNotNone(tracker.reserve('bob', 2, 0))
+        self.assertIsNone(tracker.reserve('cs101', 10, 0))
+        tracker.release('alice', 2, 0)
+        self.assertIsNone(tracker.reserve('bob', 3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file